@@ -1,12 +1,28 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, g, has_app_context, has_request_context
 import os
+import sys
 from functools import wraps
+from contextlib import contextmanager
 import sqlite3
 import hashlib
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import secrets
+import base64
+import json
+import socket
+import threading
+from collections import OrderedDict, deque
+import queue
+import time
+import csv
+import io
+import zlib
+import heapq
+import random
+import atexit
+import click
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'klevaedge-k3y-2025-xZ9qP2mN8rL4wT7v')
@@ -22,13 +38,60 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Database connections
+DB_PATH = os.environ.get('DB_PATH', '/tmp/crypto_broker.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+
+# Idle connections handed back at request teardown, reused by the next request
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def connect_db():
+    """Open a tuned connection. WAL lets readers proceed while a writer holds the lock."""
+    conn = sqlite3.connect(DB_PATH, timeout=5, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    # Must precede the WAL switch to take effect on a new file; existing databases need
+    # `flask archive-activity --vacuum-full` once
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    return conn
+
+def get_db():
+    """Connection for the current request; released automatically at teardown."""
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+        if 'request_profile' in g:
+            g.db = ProfiledConnection(g.db, g.request_profile)
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop('db', None)
+    if db is None:
+        return
+    if isinstance(db, ProfiledConnection):
+        db = db.conn
+    if db.in_transaction:
+        db.rollback()
+    account_cache.invalidate(*g.pop('touched_accounts', ()))
+    try:
+        _db_pool.put_nowait(db)
+    except queue.Full:
+        db.close()
+
 # Database setup
-def init_db_tables():
-    conn = sqlite3.connect(os.environ.get('DB_PATH', '/tmp/crypto_broker.db'))
-    c = conn.cursor()
-    
+# Schema changes are ordered, versioned steps recorded in schema_version. Every
+# step must be idempotent (IF NOT EXISTS / column checks) so databases created
+# before versioning existed can replay from version 0.
+def migration_core_tables(conn):
     # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
+    conn.execute('''CREATE TABLE IF NOT EXISTS users
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   name TEXT NOT NULL,
                   email TEXT UNIQUE NOT NULL,
@@ -40,9 +103,9 @@ def init_db_tables():
                   is_verified INTEGER DEFAULT 0,
                   verification_code TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    
+
     # Transactions table
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions
+    conn.execute('''CREATE TABLE IF NOT EXISTS transactions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   type TEXT NOT NULL,
@@ -53,14 +116,9 @@ def init_db_tables():
                   proof_file TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
-    # Add proof_file column if it doesn't exist (for existing DBs)
-    try:
-        c.execute('ALTER TABLE transactions ADD COLUMN proof_file TEXT')
-    except:
-        pass
-    
+
     # Copy Trading table
-    c.execute('''CREATE TABLE IF NOT EXISTS copy_trades
+    conn.execute('''CREATE TABLE IF NOT EXISTS copy_trades
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   trader_name TEXT NOT NULL,
@@ -70,9 +128,9 @@ def init_db_tables():
                   total_profit REAL DEFAULT 0,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
-    
+
     # Trading Activity Log
-    c.execute('''CREATE TABLE IF NOT EXISTS trading_activity
+    conn.execute('''CREATE TABLE IF NOT EXISTS trading_activity
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   activity_type TEXT,
@@ -82,7 +140,7 @@ def init_db_tables():
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
 
     # Trades table (buy/sell)
-    c.execute('''CREATE TABLE IF NOT EXISTS trades
+    conn.execute('''CREATE TABLE IF NOT EXISTS trades
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   symbol TEXT NOT NULL,
@@ -97,7 +155,7 @@ def init_db_tables():
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
 
     # Stakes table
-    c.execute('''CREATE TABLE IF NOT EXISTS stakes
+    conn.execute('''CREATE TABLE IF NOT EXISTS stakes
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   asset TEXT NOT NULL,
@@ -109,7 +167,7 @@ def init_db_tables():
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
 
     # Subscriptions table
-    c.execute('''CREATE TABLE IF NOT EXISTS subscriptions
+    conn.execute('''CREATE TABLE IF NOT EXISTS subscriptions
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   plan TEXT NOT NULL,
@@ -122,7 +180,7 @@ def init_db_tables():
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
 
     # Copy Traders table (admin managed)
-    c.execute('''CREATE TABLE IF NOT EXISTS traders
+    conn.execute('''CREATE TABLE IF NOT EXISTS traders
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   name TEXT NOT NULL,
                   country TEXT,
@@ -137,7 +195,7 @@ def init_db_tables():
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
 
     # Signals table
-    c.execute('''CREATE TABLE IF NOT EXISTS signal_purchases
+    conn.execute('''CREATE TABLE IF NOT EXISTS signal_purchases
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   signal_name TEXT NOT NULL,
@@ -146,43 +204,10 @@ def init_db_tables():
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
 
-    conn.commit()
-    conn.close()
-
-def init_db():
-    init_db_tables()
-
-def seed_traders():
-    db = get_db()
-    count = db.execute('SELECT COUNT(*) FROM traders').fetchone()[0]
-    if count == 0:
-        traders = [
-            ('Vivek Sharma', 'India', 'https://randomuser.me/api/portraits/men/32.jpg', 287.5, 74.2, 312, 109, 1200, 10),
-            ('Edo Martinez', 'Spain', 'https://randomuser.me/api/portraits/men/44.jpg', 145.8, 68.4, 198, 91, 387, 10),
-            ('W D Gann', 'USA', 'https://randomuser.me/api/portraits/men/77.jpg', 199.8, 71.0, 89, 36, 50, 25),
-            ('Echo X', 'Singapore', 'https://randomuser.me/api/portraits/men/22.jpg', 212.4, 65.8, 445, 231, 920, 10),
-            ('Coach JV', 'UK', 'https://randomuser.me/api/portraits/men/55.jpg', 176.1, 72.5, 261, 99, 620, 10),
-            ('Sarah Chen', 'China', 'https://randomuser.me/api/portraits/women/44.jpg', 134.2, 66.1, 187, 96, 510, 10),
-            ('Marcus Webb', 'Australia', 'https://randomuser.me/api/portraits/men/68.jpg', 98.7, 59.3, 142, 97, 230, 15),
-            ('Yuki Tanaka', 'Japan', 'https://randomuser.me/api/portraits/men/9.jpg', 221.0, 73.4, 389, 141, 870, 20),
-            ('Aisha Okafor', 'Nigeria', 'https://randomuser.me/api/portraits/women/68.jpg', 163.5, 67.8, 203, 96, 480, 10),
-            ('Viktor Petrov', 'Russia', 'https://randomuser.me/api/portraits/men/15.jpg', 157.9, 69.2, 278, 124, 740, 10),
-            ('Liam OBrien', 'Ireland', 'https://randomuser.me/api/portraits/men/38.jpg', 129.3, 61.8, 156, 97, 310, 12),
-            ('Priya Nair', 'India', 'https://randomuser.me/api/portraits/women/25.jpg', 189.6, 70.4, 298, 125, 590, 10),
-            ('Carlos Reyes', 'Mexico', 'https://randomuser.me/api/portraits/men/82.jpg', 111.4, 63.7, 221, 126, 430, 10),
-            ('Nadia Blanc', 'France', 'https://randomuser.me/api/portraits/women/12.jpg', 147.8, 66.9, 189, 93, 360, 15),
-            ('James Osei', 'Ghana', 'https://randomuser.me/api/portraits/men/91.jpg', 178.2, 71.6, 302, 120, 680, 10),
-        ]
-        for t in traders:
-            db.execute('INSERT INTO traders (name, country, photo, roi, win_rate, wins, losses, copiers, profit_share) VALUES (?,?,?,?,?,?,?,?,?)', t)
-        db.commit()
-    db.close()
+def migration_transaction_proof_file(conn):
+    add_column_if_missing(conn, 'transactions', 'proof_file', 'TEXT')
 
-def migrate_db():
-    """Add any missing tables to existing database - safe to run every startup."""
-    # Use direct connection to avoid dependency on get_db() which may not be defined yet
-    conn = sqlite3.connect(os.environ.get('DB_PATH', '/tmp/crypto_broker.db'))
-    conn.row_factory = sqlite3.Row
+def migration_reference_data(conn):
     conn.execute('''CREATE TABLE IF NOT EXISTS wallet_addresses (
                   id INTEGER PRIMARY KEY AUTOINCREMENT,
                   coin_id TEXT UNIQUE NOT NULL,
@@ -210,36 +235,680 @@ def migrate_db():
             ('litecoin','Litecoin','LTC','Ł','ltc1qs3glhf2ymryfpce8sxk32lj7u9xu7zuv0dayxv',1),
         ]
         conn.executemany('INSERT OR IGNORE INTO wallet_addresses (coin_id,coin_name,symbol,icon,address,is_active) VALUES (?,?,?,?,?,?)', wallets)
-    conn.commit()
+
+def migration_price_store(conn):
+    # Latest price snapshot published by the background poller (single row, id=1)
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_snapshots (
+                  id INTEGER PRIMARY KEY,
+                  data TEXT NOT NULL,
+                  fetched_at REAL NOT NULL
+                )''')
+    # Raw price ticks and OHLC rollups, clustered by (coin, time) for range scans
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_ticks (
+                  coin TEXT NOT NULL,
+                  ts INTEGER NOT NULL,
+                  price REAL NOT NULL,
+                  PRIMARY KEY (coin, ts)
+                ) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS price_rollups (
+                  coin TEXT NOT NULL,
+                  interval TEXT NOT NULL,
+                  bucket INTEGER NOT NULL,
+                  open REAL NOT NULL,
+                  high REAL NOT NULL,
+                  low REAL NOT NULL,
+                  close REAL NOT NULL,
+                  samples INTEGER NOT NULL DEFAULT 1,
+                  PRIMARY KEY (coin, interval, bucket)
+                ) WITHOUT ROWID''')
+    # Named leases used to elect a single worker for background jobs
+    conn.execute('''CREATE TABLE IF NOT EXISTS leases (
+                  name TEXT PRIMARY KEY,
+                  holder TEXT NOT NULL,
+                  expires_at REAL NOT NULL
+                )''')
+
+def migration_hot_query_indexes(conn):
+    # User history pages: WHERE user_id = ? ORDER BY created_at DESC
+    for table in ('transactions', 'trading_activity', 'trades', 'stakes', 'subscriptions',
+                  'signal_purchases', 'copy_trades'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_created ON {table} (user_id, created_at)')
+    # Deposit/withdraw pages filter on type as well
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user_type_created ON transactions (user_id, type, created_at)')
+    # Admin notifications: pending deposits/withdrawals
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_type_status_created ON transactions (type, status, created_at)')
+    # Trade page: open positions per user
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trades_user_status_created ON trades (user_id, status, created_at)')
+    # Admin dashboard and new-user notifications
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)')
+
+def migration_cache_versions(conn):
+    # One counter per cached reference dataset; bumping it invalidates every worker's copy
+    conn.execute('''CREATE TABLE IF NOT EXISTS cache_versions (
+                  name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0
+                )''')
+
+def migration_activity_cursor_index(conn):
+    # Feeds page by id (same order as created_at, but usable as a cursor), so key the
+    # hottest table's only secondary index on (user_id, id) instead
+    conn.execute('DROP INDEX IF EXISTS idx_trading_activity_user_created')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trading_activity_user_id ON trading_activity (user_id, id)')
+
+def migration_admin_user_indexes(conn):
+    # Admin user table: server-side sort columns and case-insensitive prefix search
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_profit ON users (profit)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_name_nocase ON users (name COLLATE NOCASE)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_email_nocase ON users (email COLLATE NOCASE)')
+
+def migration_admin_listing_indexes(conn):
+    # Admin listings: newest-first across all users, optionally filtered by status
+    for table in ('trades', 'stakes', 'subscriptions', 'signal_purchases', 'copy_trades'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_created ON {table} (created_at)')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_status_created ON {table} (status, created_at)')
+
+def migration_ledger(conn):
+    # Append-only money ledger. Each row is a posting between a user's wallet and `account`
+    # (the table the money moved to/from, plus 'opening' and 'adjustments'); ref_id is that
+    # table's row. users.balance/profit/total_deposit/total_withdrawal are its projection.
+    conn.execute('''CREATE TABLE IF NOT EXISTS ledger_entries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        ref_id INTEGER,
+        balance REAL NOT NULL DEFAULT 0,
+        profit REAL NOT NULL DEFAULT 0,
+        deposit REAL NOT NULL DEFAULT 0,
+        withdrawal REAL NOT NULL DEFAULT 0,
+        memo TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entries_user ON ledger_entries (user_id, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ledger_entries_account ON ledger_entries (account, ref_id)')
+    for op in ('UPDATE', 'DELETE'):
+        conn.execute(f'''CREATE TRIGGER IF NOT EXISTS ledger_entries_no_{op.lower()}
+                         BEFORE {op} ON ledger_entries
+                         BEGIN SELECT RAISE(ABORT, 'ledger_entries is append-only'); END''')
+    # Open the ledger with whatever the users table holds today
+    conn.execute('''INSERT INTO ledger_entries (user_id, account, balance, profit, deposit, withdrawal, memo)
+                    SELECT id, 'opening', balance, profit, total_deposit, total_withdrawal, 'Opening balance'
+                    FROM users
+                    WHERE balance != 0 OR profit != 0 OR total_deposit != 0 OR total_withdrawal != 0''')
+
+def migration_pending_transactions_index(conn):
+    # Admin pending queue across both deposits and withdrawals
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_status_created ON transactions (status, created_at)')
+
+def migration_trade_marks(conn):
+    # Entry/exit prices for mark-to-market P&L; covering index for open-position valuation
+    add_column_if_missing(conn, 'trades', 'entry_price', 'REAL')
+    add_column_if_missing(conn, 'trades', 'exit_price', 'REAL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trades_open_positions '
+                 'ON trades (status, symbol, trade_type, entry_price, amount)')
+
+def migration_trade_expiry(conn):
+    # Open trades close themselves once their duration runs out
+    add_column_if_missing(conn, 'trades', 'expires_at', 'TIMESTAMP')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_trades_status_expires ON trades (status, expires_at)')
+    # Frozen copy of the duration format as of this migration; don't call parse_duration()
+    units = {'m': 60, 'h': 3600, 'd': 86400}
+    for (duration,) in conn.execute("SELECT DISTINCT duration FROM trades WHERE status = 'Open'").fetchall():
+        if not duration or duration[-1] not in units or not duration[:-1].isdigit():
+            continue
+        seconds = int(duration[:-1]) * units[duration[-1]]
+        if seconds:
+            conn.execute("UPDATE trades SET expires_at = datetime(created_at, ?) WHERE status = 'Open' AND duration = ?",
+                         (f'+{seconds} seconds', duration))
+
+def migration_scheduler(conn):
+    # Run history for scheduled jobs, and an end date so subscriptions can expire
+    conn.execute('''CREATE TABLE IF NOT EXISTS job_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job TEXT NOT NULL,
+        holder TEXT,
+        started_at REAL NOT NULL,
+        duration_ms REAL,
+        status TEXT NOT NULL DEFAULT 'running',
+        result TEXT
+    )''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job, id)')
+    add_column_if_missing(conn, 'subscriptions', 'ends_at', 'TIMESTAMP')
+    conn.execute("UPDATE subscriptions SET ends_at = datetime(created_at, '+' || duration_days || ' days') WHERE ends_at IS NULL")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_subscriptions_status_ends ON subscriptions (status, ends_at)')
+
+def migration_job_finish_times(conn):
+    add_column_if_missing(conn, 'job_runs', 'finished_at', 'REAL')
+    conn.execute('UPDATE job_runs SET finished_at = started_at + duration_ms / 1000.0 '
+                 'WHERE finished_at IS NULL AND duration_ms IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_job_runs_job_finished ON job_runs (job, finished_at)')
+
+MIGRATIONS = [
+    (1, 'Core tables', migration_core_tables),
+    (2, 'transactions.proof_file', migration_transaction_proof_file),
+    (3, 'Wallet addresses and contact info', migration_reference_data),
+    (4, 'Price snapshots, history and leases', migration_price_store),
+    (5, 'Indexes for hot queries', migration_hot_query_indexes),
+    (6, 'Reference data cache versions', migration_cache_versions),
+    (7, 'Cursor index for activity feeds', migration_activity_cursor_index),
+    (8, 'Admin user table indexes', migration_admin_user_indexes),
+    (9, 'Admin listing indexes', migration_admin_listing_indexes),
+    (10, 'Ledger entries', migration_ledger),
+    (11, 'Pending transactions index', migration_pending_transactions_index),
+    (12, 'Trade entry and exit prices', migration_trade_marks),
+    (13, 'Trade expiry', migration_trade_expiry),
+    (14, 'Job runs and subscription end dates', migration_scheduler),
+    (15, 'Job run finish times', migration_job_finish_times),
+]
+
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+def parse_duration(value):
+    """'15m' / '4h' / '1d' -> seconds, or None if it isn't a duration."""
+    if not value or value[-1] not in DURATION_UNITS or not value[:-1].isdigit() or int(value[:-1]) <= 0:
+        return None
+    return int(value[:-1]) * DURATION_UNITS[value[-1]]
+
+def add_column_if_missing(conn, table, column, decl):
+    columns = [r[1] for r in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+def get_schema_version(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                  version INTEGER PRIMARY KEY,
+                  description TEXT,
+                  applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def migrate_db():
+    """Apply pending migrations, each in its own transaction. Returns the list applied."""
+    conn = connect_db()
+    applied = []
+    try:
+        get_schema_version(conn)
+        for version, description, step in MIGRATIONS:
+            # BEGIN IMMEDIATE takes the write lock first, so concurrent runners serialize
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if get_schema_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                step(conn)
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
+# Hot queries that must be served from an index. check_query_plans() flags any
+# whose plan falls back to a full table scan or a temp B-tree sort.
+HOT_QUERIES = {
+    'dashboard_transactions': ('SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 5', (1,)),
+    'user_transactions': ('SELECT * FROM transactions WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51',
+                          (1, '2100-01-01', 0)),
+    'user_deposits': ("SELECT * FROM transactions WHERE user_id = ? AND type = 'Deposit' AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51",
+                      (1, '2100-01-01', 0)),
+    'user_withdrawals': ("SELECT * FROM transactions WHERE user_id = ? AND type = 'Withdrawal' AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51",
+                         (1, '2100-01-01', 0)),
+    'user_notifications': ('SELECT * FROM trading_activity WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT 20', (1, 0)),
+    'user_latest_activity': ('SELECT id, created_at FROM trading_activity WHERE user_id = ? ORDER BY id DESC LIMIT 1', (1,)),
+    'user_unread_count': ('SELECT COUNT(*) FROM (SELECT 1 FROM trading_activity WHERE user_id = ? AND id > ? LIMIT 99)', (1, 0)),
+    'user_copy_trades': ('SELECT * FROM copy_trades WHERE user_id = ? ORDER BY created_at DESC', (1,)),
+    'user_open_trades': ("SELECT * FROM trades WHERE user_id = ? AND status = 'Open' ORDER BY created_at DESC", (1,)),
+    'user_closed_trades': ("SELECT * FROM trades WHERE user_id = ? AND status != 'Open' ORDER BY created_at DESC LIMIT 20", (1,)),
+    'user_stakes': ('SELECT * FROM stakes WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51', (1, '2100-01-01', 0)),
+    'user_subscriptions': ('SELECT * FROM subscriptions WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51',
+                           (1, '2100-01-01', 0)),
+    'user_signals': ('SELECT * FROM signal_purchases WHERE user_id = ? AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51',
+                     (1, '2100-01-01', 0)),
+    'admin_pending_deposits': ("SELECT t.*, u.name FROM transactions t JOIN users u ON t.user_id = u.id "
+                               "WHERE t.type = 'Deposit' AND t.status = 'Pending' ORDER BY t.created_at DESC LIMIT 10", ()),
+    'admin_pending_withdrawals': ("SELECT t.*, u.name FROM transactions t JOIN users u ON t.user_id = u.id "
+                                  "WHERE t.type = 'Withdrawal' AND t.status = 'Pending' ORDER BY t.created_at DESC LIMIT 10", ()),
+    'admin_new_users': ("SELECT * FROM users WHERE created_at >= datetime('now', '-7 days') ORDER BY created_at DESC LIMIT 5", ()),
+    'admin_users_page': ('SELECT id FROM users WHERE (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT 51',
+                         ('2100-01-01', 0)),
+    'admin_users_by_balance': ('SELECT id FROM users WHERE (balance, id) < (?, ?) ORDER BY balance DESC, id DESC LIMIT 51',
+                               (1e18, 0)),
+    'admin_users_by_profit': ('SELECT id FROM users WHERE (profit, id) < (?, ?) ORDER BY profit DESC, id DESC LIMIT 51',
+                              (1e18, 0)),
+    'admin_trades_page': ('SELECT x.*, u.name FROM trades x JOIN users u ON x.user_id = u.id '
+                          'WHERE (x.created_at, x.id) < (?, ?) ORDER BY x.created_at DESC, x.id DESC LIMIT 51',
+                          ('2100-01-01', 0)),
+    'admin_stakes_by_status': ('SELECT x.*, u.name FROM stakes x JOIN users u ON x.user_id = u.id '
+                               "WHERE x.status = 'Active' ORDER BY x.created_at DESC, x.id DESC LIMIT 51", ()),
+    'admin_copy_trades_dated': ('SELECT x.*, u.name FROM copy_trades x JOIN users u ON x.user_id = u.id '
+                                "WHERE x.created_at >= ? AND x.created_at < date(?, '+1 day') "
+                                'ORDER BY x.created_at DESC, x.id DESC LIMIT 51', ('2025-01-01', '2025-02-01')),
+    'admin_subscriptions_count': ("SELECT COUNT(*) FROM subscriptions x WHERE x.status = 'Active'", ()),
+    'admin_pending_page': ("SELECT t.*, u.name FROM transactions t JOIN users u ON t.user_id = u.id "
+                           "WHERE t.status = 'Pending' AND (t.created_at, t.id) < (?, ?) "
+                           'ORDER BY t.created_at DESC, t.id DESC LIMIT 51', ('2100-01-01', 0)),
+    'open_exposure': ("WITH marks(symbol, price) AS (VALUES (?, ?)) "
+                      "SELECT t.symbol, t.trade_type, COUNT(*), SUM(t.amount), MAX(marks.price) "
+                      "FROM trades t LEFT JOIN marks ON marks.symbol = t.symbol "
+                      "WHERE t.status = 'Open' GROUP BY t.symbol, t.trade_type", ('BTC', 1.0)),
+    'trigger_book_load': ('SELECT id, symbol, trade_type, stop_loss, take_profit FROM trades '
+                          "WHERE id > ? AND status = 'Open' AND (stop_loss IS NOT NULL OR take_profit IS NOT NULL)", (0,)),
+    'trades_due': ("SELECT id, symbol FROM trades WHERE status = 'Open' AND expires_at <= datetime('now') "
+                   'ORDER BY expires_at LIMIT ?', (200,)),
+    'subscriptions_due': ("SELECT * FROM subscriptions WHERE status = 'Active' AND ends_at <= datetime('now') "
+                          'ORDER BY ends_at LIMIT ?', (200,)),
+    'job_last_finished': ('SELECT MAX(finished_at) FROM job_runs WHERE job = ?', ('optimize',)),
+    'price_history': ('SELECT bucket, open, high, low, close FROM price_rollups '
+                      'WHERE coin = ? AND interval = ? AND bucket BETWEEN ? AND ? ORDER BY bucket DESC LIMIT ?',
+                      ('bitcoin', '1h', 0, 1, 1001)),
+}
+
+def check_query_plans(conn):
+    """Return {name: [problem plan lines]} for hot queries that aren't index-backed."""
+    problems = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        # Scanning a bound VALUES table (a handful of rows) is fine
+        bound = {line.split()[1] for line in plan if line.startswith('MATERIALIZE')} | {'CONSTANT'}
+        bad = [line for line in plan
+               if (line.startswith('SCAN') and 'INDEX' not in line and 'subquery' not in line.lower()
+                   and line.split()[1] not in bound)
+               or 'TEMP B-TREE' in line]
+        if bad:
+            problems[name] = bad
+    return problems
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot query is planned as a full scan or temp sort."""
+    conn = connect_db()
+    problems = check_query_plans(conn)
     conn.close()
+    for name, lines in problems.items():
+        print(f'{name}: ' + '; '.join(lines))
+    if problems:
+        raise SystemExit(1)
+    print(f'All {len(HOT_QUERIES)} hot queries use indexes.')
+
+@app.cli.command('ledger-verify')
+def ledger_verify_command():
+    """Fail if any user's balances differ from the sum of their ledger entries."""
+    conn = connect_db()
+    drift = list(ledger_drift(conn))
+    conn.close()
+    for user_id, projected, ledger in drift:
+        print(f'user {user_id}: columns {projected} != ledger {ledger}')
+    if drift:
+        raise SystemExit(1)
+    print('Ledger and balances agree.')
+
+@app.cli.command('ledger-rebuild')
+def ledger_rebuild_command():
+    """Recompute users' balance columns from ledger_entries."""
+    conn = connect_db()
+    try:
+        with balance_transaction(conn):
+            drift = list(ledger_drift(conn))
+            assignments = ', '.join(f'{column} = ?' for column in LEDGER_COLUMNS)
+            conn.executemany(f'UPDATE users SET {assignments} WHERE id = ?',
+                             [(*ledger, user_id) for user_id, _, ledger in drift])
+    finally:
+        conn.close()
+    print(f'Rebuilt balances for {len(drift)} user(s).')
 
-migrate_db()  # run after definition
+def init_db():
+    migrate_db()
+    seed_traders()
 
-def get_wallets():
+def verify_schema():
+    """Cheap boot-time check: compare the recorded schema version, never run DDL."""
+    latest = MIGRATIONS[-1][0]
+    conn = connect_db()
     try:
-        db = get_db()
-        rows = db.execute('SELECT * FROM wallet_addresses WHERE is_active=1 ORDER BY id').fetchall()
-        db.close()
-        return [dict(r) for r in rows]
-    except:
-        migrate_db()
-        db = get_db()
-        rows = db.execute('SELECT * FROM wallet_addresses WHERE is_active=1 ORDER BY id').fetchall()
-        db.close()
-        return [dict(r) for r in rows]
+        row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+        current = row[0] or 0
+    except sqlite3.OperationalError:
+        current = 0
+    finally:
+        conn.close()
+    if current < latest:
+        app.logger.error('Database schema is at version %s, expected %s. Run `flask --app app init-db`.',
+                         current, latest)
+    return current
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create/upgrade the schema and seed default data."""
+    init_db()
+    print(f'Database ready at schema version {MIGRATIONS[-1][0]}.')
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations only."""
+    applied = migrate_db()
+    print(f'Applied migrations: {applied}' if applied else 'Schema is up to date.')
+
+# Warn at boot about an unmigrated database, except when the CLI is about to migrate it
+if not {'init-db', 'migrate'} & set(sys.argv[1:]):
+    verify_schema()
+
+def seed_traders():
+    db = connect_db()
+    count = db.execute('SELECT COUNT(*) FROM traders').fetchone()[0]
+    if count == 0:
+        traders = [
+            ('Vivek Sharma', 'India', 'https://randomuser.me/api/portraits/men/32.jpg', 287.5, 74.2, 312, 109, 1200, 10),
+            ('Edo Martinez', 'Spain', 'https://randomuser.me/api/portraits/men/44.jpg', 145.8, 68.4, 198, 91, 387, 10),
+            ('W D Gann', 'USA', 'https://randomuser.me/api/portraits/men/77.jpg', 199.8, 71.0, 89, 36, 50, 25),
+            ('Echo X', 'Singapore', 'https://randomuser.me/api/portraits/men/22.jpg', 212.4, 65.8, 445, 231, 920, 10),
+            ('Coach JV', 'UK', 'https://randomuser.me/api/portraits/men/55.jpg', 176.1, 72.5, 261, 99, 620, 10),
+            ('Sarah Chen', 'China', 'https://randomuser.me/api/portraits/women/44.jpg', 134.2, 66.1, 187, 96, 510, 10),
+            ('Marcus Webb', 'Australia', 'https://randomuser.me/api/portraits/men/68.jpg', 98.7, 59.3, 142, 97, 230, 15),
+            ('Yuki Tanaka', 'Japan', 'https://randomuser.me/api/portraits/men/9.jpg', 221.0, 73.4, 389, 141, 870, 20),
+            ('Aisha Okafor', 'Nigeria', 'https://randomuser.me/api/portraits/women/68.jpg', 163.5, 67.8, 203, 96, 480, 10),
+            ('Viktor Petrov', 'Russia', 'https://randomuser.me/api/portraits/men/15.jpg', 157.9, 69.2, 278, 124, 740, 10),
+            ('Liam OBrien', 'Ireland', 'https://randomuser.me/api/portraits/men/38.jpg', 129.3, 61.8, 156, 97, 310, 12),
+            ('Priya Nair', 'India', 'https://randomuser.me/api/portraits/women/25.jpg', 189.6, 70.4, 298, 125, 590, 10),
+            ('Carlos Reyes', 'Mexico', 'https://randomuser.me/api/portraits/men/82.jpg', 111.4, 63.7, 221, 126, 430, 10),
+            ('Nadia Blanc', 'France', 'https://randomuser.me/api/portraits/women/12.jpg', 147.8, 66.9, 189, 93, 360, 15),
+            ('James Osei', 'Ghana', 'https://randomuser.me/api/portraits/men/91.jpg', 178.2, 71.6, 302, 120, 680, 10),
+        ]
+        for t in traders:
+            db.execute('INSERT INTO traders (name, country, photo, roi, win_rate, wins, losses, copiers, profit_share) VALUES (?,?,?,?,?,?,?,?,?)', t)
+        invalidate_reference(db, 'traders')
+        db.commit()
+    db.close()
+
+
+# Request profiling. With PROFILING=1 every request records wall time, SQL statement count
+# and time (through a wrapper around the get_db() connection), upstream price-API time and
+# response size per endpoint, and statements slower than SLOW_QUERY_MS are logged with their
+# query plan. With it off (the default) no hooks are registered and get_db() is untouched.
+# Streamed responses are measured up to the point the stream starts.
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_LOG_SIZE = 50
+
+class RequestProfiler:
+    """Per-endpoint request totals plus a ring buffer of recent slow statements."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.upstream = {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+
+    def record(self, endpoint, wall_ms, profile, size):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'sql_statements': 0,
+                'sql_ms': 0.0, 'http_ms': 0.0, 'bytes': 0})
+            stats['requests'] += 1
+            stats['total_ms'] += wall_ms
+            stats['max_ms'] = max(stats['max_ms'], wall_ms)
+            stats['sql_statements'] += profile['sql_statements']
+            stats['sql_ms'] += profile['sql_ms']
+            stats['http_ms'] += profile['http_ms']
+            stats['bytes'] += size or 0
+
+    def note_upstream(self, elapsed_ms):
+        with self.lock:
+            self.upstream['calls'] += 1
+            self.upstream['total_ms'] += elapsed_ms
+            self.upstream['max_ms'] = max(self.upstream['max_ms'], elapsed_ms)
+        if has_request_context() and 'request_profile' in g:
+            g.request_profile['http_ms'] += elapsed_ms
+
+    def note_slow_query(self, sql, elapsed_ms, plan):
+        app.logger.warning('Slow query (%.1f ms) in %s: %s | plan: %s', elapsed_ms,
+                           request.endpoint if has_request_context() else '-', ' '.join(sql.split()), '; '.join(plan))
+        with self.lock:
+            self.slow_queries.append({'at': time.time(), 'ms': round(elapsed_ms, 1), 'sql': ' '.join(sql.split()),
+                                      'plan': plan, 'endpoint': request.endpoint if has_request_context() else None})
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {}
+            for name, stats in self.endpoints.items():
+                n = stats['requests']
+                endpoints[name] = {'requests': n, 'avg_ms': round(stats['total_ms'] / n, 2),
+                                   'max_ms': round(stats['max_ms'], 2), 'total_ms': round(stats['total_ms'], 1),
+                                   'avg_sql_statements': round(stats['sql_statements'] / n, 1),
+                                   'avg_sql_ms': round(stats['sql_ms'] / n, 2),
+                                   'avg_http_ms': round(stats['http_ms'] / n, 2),
+                                   'avg_bytes': round(stats['bytes'] / n)}
+            return {'enabled': PROFILING, 'slow_query_ms': SLOW_QUERY_MS,
+                    'endpoints': dict(sorted(endpoints.items(), key=lambda e: e[1]['total_ms'], reverse=True)),
+                    'upstream': dict(self.upstream, total_ms=round(self.upstream['total_ms'], 1),
+                                     max_ms=round(self.upstream['max_ms'], 1)),
+                    'slow_queries': list(self.slow_queries)}
+
+request_profiler = RequestProfiler()
+
+class ProfiledConnection:
+    """Stands in for the request's sqlite3 connection, timing every statement."""
+
+    def __init__(self, conn, profile):
+        self.conn = conn
+        self.profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        cursor = self.conn.execute(sql, params)
+        return ProfiledCursor(cursor, self, sql, params, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        started = time.perf_counter()
+        cursor = self.conn.executemany(sql, seq_of_params)
+        self.finish(sql, seq_of_params[0] if seq_of_params else (), (time.perf_counter() - started) * 1000)
+        return cursor
+
+    def finish(self, sql, params, elapsed_ms):
+        self.profile['sql_statements'] += 1
+        self.profile['sql_ms'] += elapsed_ms
+        if elapsed_ms >= SLOW_QUERY_MS and not sql.lstrip().upper().startswith(('EXPLAIN', 'PRAGMA')):
+            try:
+                plan = [row[3] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+            except sqlite3.Error as e:
+                plan = [f'unavailable: {e}']
+            request_profiler.note_slow_query(sql, elapsed_ms, plan)
+
+class ProfiledCursor:
+    """Cursor whose fetches and iteration are timed; the statement is reported once fully read."""
+
+    def __init__(self, cursor, conn, sql, params, elapsed_ms):
+        self.cursor = cursor
+        self.conn = conn
+        self.sql = sql
+        self.params = params
+        self.elapsed_ms = elapsed_ms
+        if cursor.description is None:
+            self.done()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        started = time.perf_counter()
+        for row in self.cursor:
+            self.elapsed_ms += (time.perf_counter() - started) * 1000
+            yield row
+            started = time.perf_counter()
+        self.elapsed_ms += (time.perf_counter() - started) * 1000
+        self.done()
+
+    def done(self):
+        if self.sql is not None:
+            self.conn.finish(self.sql, self.params, self.elapsed_ms)
+            self.sql = None
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.elapsed_ms += (time.perf_counter() - started) * 1000
+        self.done()
+        return row
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.elapsed_ms += (time.perf_counter() - started) * 1000
+        self.done()
+        return rows
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = self.cursor.fetchmany(size or self.cursor.arraysize)
+        self.elapsed_ms += (time.perf_counter() - started) * 1000
+        if len(rows) < (size or self.cursor.arraysize):
+            self.done()
+        return rows
+
+if PROFILING:
+    @app.before_request
+    def start_request_profile():
+        g.request_profile = {'started': time.perf_counter(), 'sql_statements': 0, 'sql_ms': 0.0, 'http_ms': 0.0}
+
+    @app.after_request
+    def finish_request_profile(response):
+        profile = g.get('request_profile')
+        if profile is None:
+            return response
+        wall_ms = (time.perf_counter() - profile['started']) * 1000
+        size = None if response.is_streamed else response.calculate_content_length()
+        request_profiler.record(request.endpoint or 'not_found', wall_ms, profile, size)
+        response.headers['Server-Timing'] = (f'app;dur={wall_ms:.1f}, '
+                                             f'sql;dur={profile["sql_ms"]:.1f};desc="{profile["sql_statements"]} statements", '
+                                             f'upstream;dur={profile["http_ms"]:.1f}')
+        return response
+
+# Reference data cache
+# Wallets, contact info and traders only change through admin routes. Each worker
+# keeps a copy tagged with the cache_versions counter it was loaded at; admin
+# writes bump the counter in the same transaction, and other workers notice on
+# their next version check (at most every REFERENCE_CACHE_CHECK_INTERVAL seconds).
+REFERENCE_CACHE_CHECK_INTERVAL = float(os.environ.get('REFERENCE_CACHE_CHECK_INTERVAL', 1))
+_reference_cache = {}
+_reference_cache_lock = threading.Lock()
+
+def get_reference(name, loader):
+    db = get_db()
+    entry = _reference_cache.get(name)
+    now = time.monotonic()
+    if entry and now - entry['checked_at'] < REFERENCE_CACHE_CHECK_INTERVAL:
+        return entry['value']
+    row = db.execute('SELECT version FROM cache_versions WHERE name = ?', (name,)).fetchone()
+    version = row['version'] if row else 0
+    if entry and entry['version'] == version:
+        entry['checked_at'] = now
+        return entry['value']
+    with _reference_cache_lock:
+        value = loader(db)
+        _reference_cache[name] = {'version': version, 'value': value, 'checked_at': now}
+    return value
+
+def invalidate_reference(db, *names):
+    """Bump the version of each dataset. Call before committing the write it describes."""
+    for name in names:
+        db.execute('INSERT INTO cache_versions (name, version) VALUES (?, 1) '
+                   'ON CONFLICT(name) DO UPDATE SET version = version + 1', (name,))
+        _reference_cache.pop(name, None)
+
+def get_wallets():
+    return get_reference('wallets', lambda db: [
+        dict(r) for r in db.execute('SELECT * FROM wallet_addresses WHERE is_active=1 ORDER BY id').fetchall()])
 
 def get_contact():
-    try:
-        db = get_db()
+    def load(db):
         row = db.execute('SELECT * FROM contact_info WHERE id=1').fetchone()
-        db.close()
-        return dict(row) if row else {}
-    except:
-        migrate_db()
-        db = get_db()
-        row = db.execute('SELECT * FROM contact_info WHERE id=1').fetchone()
-        db.close()
         return dict(row) if row else {}
+    return get_reference('contact', load)
+
+def get_traders():
+    return get_reference('traders', lambda db: [
+        dict(r) for r in db.execute('SELECT * FROM traders ORDER BY created_at DESC').fetchall()])
+
+# Copy-trading leaderboard: active traders pre-sorted by each rankable column.
+# Rebuilt only when get_traders() returns a new list, i.e. after a trader edit.
+TRADER_SORT_KEYS = ('roi', 'win_rate', 'copiers')
+TRADERS_PER_PAGE = int(os.environ.get('TRADERS_PER_PAGE', 10))
+_trader_ranking = {'source': None}
+
+def get_trader_ranking():
+    global _trader_ranking
+    traders = get_traders()
+    ranking = _trader_ranking
+    if ranking['source'] is not traders:
+        active = [t for t in traders if t['is_active']]
+        ranking = {
+            'source': traders,
+            'by': {key: sorted(active, key=lambda t, key=key: (t[key] or 0, -t['id']), reverse=True)
+                   for key in TRADER_SORT_KEYS},
+            'countries': sorted({t['country'] for t in active if t['country']}),
+        }
+        _trader_ranking = ranking
+    return ranking
+
+# Keyset pagination
+# Pages are seeked with "WHERE (sort, id) < (last sort, last id)" instead of OFFSET,
+# so fetching page N costs the same as page 1 when an index covers (filters, sort).
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+
+def encode_cursor(value, row_id):
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    # Cursors come back from the client; anything but a scalar sort key and an integer id is tampered
+    if not isinstance(value, (str, int, float, type(None))) or isinstance(row_id, bool) or not isinstance(row_id, int):
+        return None
+    return value, row_id
+
+def keyset_page(db, select, where=(), params=(), cursor=None, sort='created_at', id_col='id',
+                desc=True, limit=PAGE_SIZE):
+    """Run `select` with optional WHERE clauses, seeking past `cursor`.
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    `sort`/`id_col` may be qualified ("t.created_at"); rows are read by bare name.
+    """
+    clauses, args = list(where), list(params)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        clauses.append(f'({sort}, {id_col}) {"<" if desc else ">"} (?, ?)')
+        args += list(position)
+    direction = 'DESC' if desc else 'ASC'
+    sql = select
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    sql += f' ORDER BY {sort} {direction}, {id_col} {direction} LIMIT ?'
+    rows = db.execute(sql, args + [limit + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[sort.split('.')[-1]], last[id_col.split('.')[-1]])
+    return rows[:limit], next_cursor
+
+def history_page(db, table, user_id, where=(), params=()):
+    """One page of a user's history from `table`, newest first, seeking past ?cursor=."""
+    return keyset_page(db, f'SELECT * FROM {table}', ['user_id = ?', *where], [user_id, *params],
+                       cursor=request.args.get('cursor'))
+
+def history_json(rows, next_cursor):
+    return jsonify({'items': [dict(r) for r in rows], 'next_cursor': next_cursor})
+
+def wants_json():
+    return request.args.get('format') == 'json'
 
 # Admin credentials (change these!)
 ADMIN_EMAIL = 'abessidiksas@hotmail.com'
@@ -249,14 +918,6 @@ ADMIN_PASSWORD = hashlib.sha256('MAro45??!!'.encode()).hexdigest()
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
-def get_db():
-    conn = sqlite3.connect(os.environ.get('DB_PATH', '/tmp/crypto_broker.db'))
-    conn.row_factory = sqlite3.Row
-    return conn
-
-init_db()
-seed_traders()
-
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -275,110 +936,1280 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Per-user account summaries (user row, recent transactions, active copy trades, recent
+# activity), cached in-process. Write paths call touch_account(); the entry is dropped once
+# the writing transaction commits. With several workers, other processes' copies can lag
+# by up to ACCOUNT_CACHE_TTL seconds.
+ACCOUNT_CACHE_SIZE = int(os.environ.get('ACCOUNT_CACHE_SIZE', 1000))
+ACCOUNT_CACHE_TTL = float(os.environ.get('ACCOUNT_CACHE_TTL', 30))
+
+class AccountCache:
+    """LRU + TTL cache keyed by user id.
+
+    A per-user generation counter is bumped on every invalidation; a load only stores its
+    result if the generation didn't move while it was reading, so a read that started
+    before a commit can't put pre-commit data back into the cache.
+    """
+
+    def __init__(self, loader, size, ttl):
+        self.loader = loader
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, db, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry and time.monotonic() - entry[1] < self.ttl:
+                self.entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            generation = self.generations.get(user_id, 0)
+        value = self.loader(db, user_id)
+        with self.lock:
+            if value is not None and self.generations.get(user_id, 0) == generation:
+                self.entries[user_id] = (value, time.monotonic())
+                self.entries.move_to_end(user_id)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+        return value
+
+    def invalidate(self, *user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.generations[user_id] = self.generations.get(user_id, 0) + 1
+                if self.entries.pop(user_id, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {'size': len(self.entries), 'capacity': self.size, 'ttl': self.ttl,
+                    'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else None, **self.stats}
+
+def load_account_summary(db, user_id):
+    user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+    if user is None:
+        return None
+    return {
+        'user': {key: user[key] for key in user.keys() if key != 'password'},
+        'transactions': [dict(r) for r in db.execute(
+            'SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 5', (user_id,))],
+        'copy_trades': [dict(r) for r in db.execute(
+            "SELECT * FROM copy_trades WHERE user_id = ? AND status = 'Active' ORDER BY created_at DESC", (user_id,))],
+        'activities': [dict(r) for r in db.execute(
+            'SELECT * FROM trading_activity WHERE user_id = ? ORDER BY id DESC LIMIT 10', (user_id,))],
+    }
+
+account_cache = AccountCache(load_account_summary, ACCOUNT_CACHE_SIZE, ACCOUNT_CACHE_TTL)
+
+# Side effects of the current thread's balance_transaction() that must wait for its COMMIT:
+# accounts touched outside an app context (price poller, scheduler), invalidated once it
+# commits, and batched activity rows, queued once it commits and dropped if it rolls back
+_pending_writes = threading.local()
+
+def touch_account(*user_ids):
+    """Mark users' cached summaries stale once the current writes are committed."""
+    if has_app_context():
+        g.setdefault('touched_accounts', set()).update(user_ids)
+    elif getattr(_pending_writes, 'touched', None) is not None:
+        _pending_writes.touched.update(user_ids)
+    else:
+        account_cache.invalidate(*user_ids)
+
+def current_account(db):
+    return account_cache.get(db, session['user_id'])
+
+# Balance mutations. Money only moves inside balance_transaction(), together with the rows
+# that justify it; debits are one guarded UPDATE, so concurrent requests can't overdraw.
+# Every movement is also appended to ledger_entries; the users columns are its projection.
+class InsufficientBalance(Exception):
+    pass
+
+class StaleState(Exception):
+    """The row being settled was no longer in the expected status (e.g. closed twice)."""
+
+class UnknownAccount(Exception):
+    """No user row with that id."""
+
+@contextmanager
+def balance_transaction(db):
+    """BEGIN IMMEDIATE ... COMMIT; rolls back if the block raises."""
+    db.execute('BEGIN IMMEDIATE')
+    _pending_writes.touched, _pending_writes.activity = set(), []
+    try:
+        try:
+            yield db
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        if has_app_context():
+            account_cache.invalidate(*g.pop('touched_accounts', ()))
+        account_cache.invalidate(*_pending_writes.touched)
+        if _pending_writes.activity:
+            activity_writer.enqueue(db, _pending_writes.activity)
+    finally:
+        _pending_writes.touched = _pending_writes.activity = None
+
+def record_ledger(db, user_id, account, ref_id=None, balance=0, profit=0, deposit=0, withdrawal=0, memo=None):
+    """Append one posting: the user's columns move by the deltas, `account` by -balance."""
+    db.execute('INSERT INTO ledger_entries (user_id, account, ref_id, balance, profit, deposit, withdrawal, memo) '
+               'VALUES (?,?,?,?,?,?,?,?)', (user_id, account, ref_id, balance, profit, deposit, withdrawal, memo))
+
+def debit_balance(db, user_id, amount, account, ref_id=None):
+    if amount <= 0:
+        raise ValueError('debit amount must be positive')
+    cur = db.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ?',
+                     (amount, user_id, amount))
+    if cur.rowcount != 1:
+        raise InsufficientBalance()
+    record_ledger(db, user_id, account, ref_id, balance=-amount)
+    touch_account(user_id)
+
+def credit_balance(db, user_id, amount, account, ref_id=None, profit=0, deposit=0):
+    db.execute('UPDATE users SET balance = balance + ?, profit = profit + ?, total_deposit = total_deposit + ? '
+               'WHERE id = ?', (amount, profit, deposit, user_id))
+    record_ledger(db, user_id, account, ref_id, balance=amount, profit=profit, deposit=deposit)
+    touch_account(user_id)
+
+def adjust_balances(db, user_id, memo=None, **targets):
+    """Admin override: post the difference to each target as an 'adjustments' entry."""
+    user = db.execute('SELECT balance, profit, total_deposit, total_withdrawal FROM users WHERE id = ?',
+                      (user_id,)).fetchone()
+    if user is None:
+        raise UnknownAccount(user_id)
+    deltas = {column: float(targets[column]) - user[column] for column in LEDGER_COLUMNS
+              if targets.get(column) not in (None, '')}
+    if not any(deltas.values()):
+        return
+    assignments = ', '.join(f'{column} = {column} + ?' for column in deltas)
+    db.execute(f'UPDATE users SET {assignments} WHERE id = ?', (*deltas.values(), user_id))
+    record_ledger(db, user_id, 'adjustments', memo=memo,
+                  **{LEDGER_COLUMNS[column]: delta for column, delta in deltas.items()})
+    touch_account(user_id)
+
+# users column -> ledger_entries column
+LEDGER_COLUMNS = {'balance': 'balance', 'profit': 'profit', 'total_deposit': 'deposit',
+                  'total_withdrawal': 'withdrawal'}
+
+def ledger_drift(conn):
+    """Yield (user_id, projected, ledger) for users whose columns disagree with their ledger sums.
+
+    One pass: the ledger is aggregated along idx_ledger_entries_user and joined to users.
+    """
+    sums = ', '.join(f'SUM({column}) AS {column}' for column in LEDGER_COLUMNS.values())
+    projected = ', '.join(f'u.{column}' for column in LEDGER_COLUMNS)
+    totals = ', '.join(f'COALESCE(l.{column}, 0)' for column in LEDGER_COLUMNS.values())
+    rows = conn.execute(f'SELECT u.id, {projected}, {totals} FROM users u LEFT JOIN '
+                        f'(SELECT user_id, {sums} FROM ledger_entries GROUP BY user_id) l ON l.user_id = u.id')
+    width = len(LEDGER_COLUMNS)
+    for row in rows:
+        projected, ledger = tuple(row[1:1 + width]), tuple(row[1 + width:])
+        if any(abs((p or 0) - q) > 0.005 for p, q in zip(projected, ledger)):
+            yield row[0], projected, ledger
+
+def set_status(db, table, row_id, expected, status, **fields):
+    """Move a row from `expected` to `status` (plus `fields`); StaleState if it had moved on."""
+    assignments = ', '.join(['status = ?'] + [f'{column} = ?' for column in fields])
+    cur = db.execute(f'UPDATE {table} SET {assignments} WHERE id = ? AND status = ?',
+                     (status, *fields.values(), row_id, expected))
+    if cur.rowcount != 1:
+        raise StaleState()
+
+# Activity log writer. In 'sync' mode (the default) activity rows are inserted in the caller's
+# transaction. In 'batched' mode they are queued and flushed with executemany every
+# ACTIVITY_FLUSH_INTERVAL seconds or ACTIVITY_FLUSH_SIZE rows, which takes trading_activity
+# off the request's write lock. Rows logged inside a balance_transaction() are only queued
+# once it commits, so a rolled-back trade leaves no notification behind. A hard crash can lose the last interval's notifications;
+# balances and ledger_entries never go through the queue.
+ACTIVITY_WRITE_MODE = os.environ.get('ACTIVITY_WRITE_MODE', 'sync')
+ACTIVITY_FLUSH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_SIZE', 200))
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 0.5))
+ACTIVITY_QUEUE_MAX = int(os.environ.get('ACTIVITY_QUEUE_MAX', 10000))
+
+class ActivityWriter:
+    """Write-behind buffer for trading_activity inserts.
+
+    Rows leave the queue only inside flush() while flush_lock is held, so a flush at
+    shutdown waits for any in-flight batch and then drains the rest.
+    """
+
+    INSERT = ('INSERT INTO trading_activity (user_id, activity_type, description, amount, created_at) '
+              'VALUES (?,?,?,?,?)')
+
+    def __init__(self, mode, batch_size, interval, max_queue):
+        self.batched = mode == 'batched'
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.wakeup = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.stats_lock = threading.Lock()  # counters are bumped by request threads and the writer
+        self.conn = None
+        self.pid = None
+        self.stats = {'queued': 0, 'written': 0, 'flushes': 0, 'overflows': 0, 'dropped': 0,
+                      'max_depth': 0, 'last_flush_ms': None, 'max_flush_ms': 0.0, 'total_flush_ms': 0.0}
+
+    def log_many(self, db, rows):
+        """Record (user_id, activity_type, description, amount) rows; `db` is the caller's connection."""
+        rows = list(rows)
+        touch_account(*{row[0] for row in rows})
+        if not self.batched:
+            db.executemany('INSERT INTO trading_activity (user_id, activity_type, description, amount) '
+                           'VALUES (?,?,?,?)', rows)
+            return
+        stamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        rows = [(*row, stamp) for row in rows]
+        pending = getattr(_pending_writes, 'activity', None)
+        if pending is not None:
+            pending.extend(rows)
+        else:
+            self.enqueue(db, rows)
+
+    def enqueue(self, db, rows):
+        """Queue stamped rows for the next flush; whatever doesn't fit is written through `db`."""
+        self._ensure_thread()
+        queued = overflow = 0
+        for i, row in enumerate(rows):
+            try:
+                self.queue.put_nowait(row)
+            except queue.Full:
+                # Back-pressure: write the overflow directly instead of dropping it, in the
+                # caller's transaction if one is open, else in a short one of its own
+                overflow = len(rows) - i
+                own_transaction = not db.in_transaction
+                db.executemany(self.INSERT, rows[i:])
+                if own_transaction:
+                    db.commit()
+                break
+            queued += 1
+        depth = self.queue.qsize()
+        with self.stats_lock:
+            self.stats['queued'] += queued
+            self.stats['overflows'] += overflow
+            self.stats['max_depth'] = max(self.stats['max_depth'], depth)
+        if depth >= self.batch_size:
+            self.wakeup.set()
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork; start one per serving process
+        if self.pid != os.getpid():
+            self.pid, self.conn = os.getpid(), None
+            threading.Thread(target=self._run, daemon=True, name='activity-writer').start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.warning('Activity writer: %s', e)
+
+    def flush(self):
+        """Write everything queued so far, in batch_size chunks."""
+        with self.flush_lock:
+            while True:
+                batch = []
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not batch:
+                    return
+                self._write(batch)
+
+    def _write(self, batch):
+        started = time.monotonic()
+        for attempt in range(3):
+            try:
+                if self.conn is None:
+                    self.conn = connect_db()
+                with self.conn:
+                    self.conn.executemany(self.INSERT, batch)
+                break
+            except sqlite3.Error as e:
+                app.logger.warning('Activity writer flush failed (attempt %d): %s', attempt + 1, e)
+                time.sleep(0.2 * (attempt + 1))
+        else:
+            with self.stats_lock:
+                self.stats['dropped'] += len(batch)
+            return
+        account_cache.invalidate(*{row[0] for row in batch})
+        elapsed = (time.monotonic() - started) * 1000
+        with self.stats_lock:
+            self.stats['written'] += len(batch)
+            self.stats['flushes'] += 1
+            self.stats['last_flush_ms'] = round(elapsed, 2)
+            self.stats['max_flush_ms'] = round(max(self.stats['max_flush_ms'], elapsed), 2)
+            self.stats['total_flush_ms'] += elapsed
+
+    def snapshot(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['avg_flush_ms'] = round(stats.pop('total_flush_ms') / stats['flushes'], 2) if stats['flushes'] else None
+        return {'mode': 'batched' if self.batched else 'sync', 'depth': self.queue.qsize(),
+                'batch_size': self.batch_size, 'interval': self.interval, **stats}
+
+activity_writer = ActivityWriter(ACTIVITY_WRITE_MODE, ACTIVITY_FLUSH_SIZE, ACTIVITY_FLUSH_INTERVAL, ACTIVITY_QUEUE_MAX)
+atexit.register(activity_writer.flush)
+
+def log_activity(db, user_id, activity_type, description, amount):
+    activity_writer.log_many(db, [(user_id, activity_type, description, amount)])
+
+# Activity retention. Rows older than ACTIVITY_RETENTION_DAYS move to an attached archive
+# database as zlib-compressed NDJSON chunks, ARCHIVE_BATCH_SIZE rows per transaction; each
+# user's newest NOTIFICATION_FEED_SIZE rows always stay so their feed never goes empty.
+ACTIVITY_RETENTION_DAYS = int(os.environ.get('ACTIVITY_RETENTION_DAYS', 90))
+ARCHIVE_DB_PATH = os.environ.get('ARCHIVE_DB_PATH', os.path.splitext(DB_PATH)[0] + '_archive.db')
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_BATCH_PAUSE = float(os.environ.get('ARCHIVE_BATCH_PAUSE', 0.05))
+
+def database_bytes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return pages * page_size, free * page_size
+
+def archive_activity(conn, days=None, batch_size=None, vacuum_full=False):
+    """Move old trading_activity rows into the archive database, then reclaim the space.
+
+    Returns counts of rows and chunks archived, compressed bytes written and bytes reclaimed.
+    Chunks are keyed by their first row id, so re-running after a crash overwrites rather
+    than duplicates a chunk whose delete didn't commit.
+    """
+    days = ACTIVITY_RETENTION_DAYS if days is None else days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DB_PATH,))
+    try:
+        conn.execute('''CREATE TABLE IF NOT EXISTS archive.trading_activity_chunks (
+            first_id INTEGER PRIMARY KEY,
+            last_id INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            oldest TIMESTAMP,
+            newest TIMESTAMP,
+            data BLOB NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''')
+        conn.commit()
+        size_before, _ = database_bytes(conn)
+        stats = {'rows': 0, 'chunks': 0, 'archive_bytes': 0, 'reclaimed_bytes': 0}
+        while True:
+            with balance_transaction(conn):
+                rows = conn.execute('''SELECT * FROM trading_activity a WHERE created_at < ?
+                                       AND id < COALESCE((SELECT id FROM trading_activity k WHERE k.user_id = a.user_id
+                                                          ORDER BY id DESC LIMIT 1 OFFSET ?), 0)
+                                       ORDER BY id LIMIT ?''',
+                                    (cutoff, NOTIFICATION_FEED_SIZE - 1, batch_size)).fetchall()
+                if not rows:
+                    break
+                data = zlib.compress(''.join(json.dumps(dict(r), default=str) + '\n' for r in rows).encode(), 9)
+                conn.execute('INSERT OR REPLACE INTO archive.trading_activity_chunks '
+                             '(first_id, last_id, row_count, oldest, newest, data) VALUES (?,?,?,?,?,?)',
+                             (rows[0]['id'], rows[-1]['id'], len(rows), min(r['created_at'] for r in rows),
+                              max(r['created_at'] for r in rows), data))
+                conn.executemany('DELETE FROM trading_activity WHERE id = ?', [(r['id'],) for r in rows])
+            stats['rows'] += len(rows)
+            stats['chunks'] += 1
+            stats['archive_bytes'] += len(data)
+            time.sleep(ARCHIVE_BATCH_PAUSE)  # let request writers in between batches
+    finally:
+        conn.execute('DETACH DATABASE archive')
+    if vacuum_full:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+    elif conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        conn.execute('PRAGMA incremental_vacuum').fetchall()  # frees one page per step
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    size_after, free_after = database_bytes(conn)
+    stats['reclaimed_bytes'] = size_before - size_after
+    stats['free_bytes'] = free_after
+    return stats
+
+@app.cli.command('archive-activity')
+@click.option('--days', type=int, default=None, help='Retention age (default ACTIVITY_RETENTION_DAYS).')
+@click.option('--vacuum-full', is_flag=True, help='Run a full VACUUM, switching older databases to incremental auto-vacuum.')
+def archive_activity_command(days, vacuum_full):
+    """Archive old trading_activity rows and reclaim their space."""
+    conn = connect_db()
+    try:
+        stats = archive_activity(conn, days=days, vacuum_full=vacuum_full)
+    finally:
+        conn.close()
+    print(f"Archived {stats['rows']} row(s) in {stats['chunks']} chunk(s) "
+          f"({stats['archive_bytes']} bytes compressed) to {ARCHIVE_DB_PATH}; "
+          f"reclaimed {stats['reclaimed_bytes']} bytes, {stats['free_bytes']} bytes still free.")
+
+def request_withdrawal(db, user_id, amount, crypto, wallet_address):
+    """Queue a withdrawal only if balance covers it plus every withdrawal still pending."""
+    if amount <= 0:
+        raise ValueError('withdrawal amount must be positive')
+    cur = db.execute('''INSERT INTO transactions (user_id, type, amount, crypto, wallet_address, status)
+                        SELECT id, 'Withdrawal', ?, ?, ?, 'Pending' FROM users
+                        WHERE id = ? AND balance - (SELECT COALESCE(SUM(amount), 0) FROM transactions
+                                                    WHERE user_id = users.id AND type = 'Withdrawal'
+                                                    AND status = 'Pending') >= ?''',
+                     (amount, crypto, wallet_address, user_id, amount))
+    if cur.rowcount != 1:
+        raise InsufficientBalance()
+    touch_account(user_id)
+
+# Crypto price cache
+COINGECKO_URL = 'https://api.coingecko.com/api/v3/simple/price'
+PRICE_COINS = ('bitcoin', 'ethereum', 'tether', 'litecoin', 'solana', 'ripple', 'dogecoin', 'cardano')
+PRICE_POLLER_ENABLED = os.environ.get('PRICE_POLLER', '1') == '1'
+PRICE_POLL_INTERVAL = float(os.environ.get('PRICE_POLL_INTERVAL', 30))
+# With the poller on, the cache only re-reads the shared snapshot row, so it can be short
+PRICE_CACHE_TTL = float(os.environ.get('PRICE_CACHE_TTL', 5 if PRICE_POLLER_ENABLED else 30))
+PRICE_CACHE_MAX_STALE = float(os.environ.get('PRICE_CACHE_MAX_STALE', 600))
+
+def fetch_crypto_prices():
+    started = time.perf_counter()
+    response = requests.get(
+        COINGECKO_URL,
+        params={
+            'ids': ','.join(PRICE_COINS),
+            'vs_currencies': 'usd',
+            'include_24hr_change': 'true'
+        },
+        timeout=5
+    )
+    if PROFILING:
+        request_profiler.note_upstream((time.perf_counter() - started) * 1000)
+    if response.status_code != 200:
+        raise RuntimeError('Failed to fetch prices')
+    data = response.json()
+    return {coin: {'price': data[coin]['usd'], 'change': data[coin]['usd_24h_change']}
+            for coin in PRICE_COINS}
+
+class PriceCache:
+    """Stale-while-revalidate cache around a loader, with single-flight refresh.
+
+    Fresh values (younger than ttl) are served directly. Stale values (younger
+    than max_stale) are served immediately while one background refresh runs.
+    Only a cold or expired cache makes the caller wait, and concurrent callers
+    then share one upstream fetch instead of each starting their own.
+    """
+
+    def __init__(self, loader, ttl, max_stale):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.value = None
+        self.fetched_at = 0.0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.refreshed = threading.Condition(self.lock)
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0,
+                      'last_refresh_ms': None, 'total_refresh_ms': 0.0}
+
+    def _usable(self, now):
+        return self.value is not None and now - self.fetched_at < self.max_stale
+
+    def get(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.value is not None and now - self.fetched_at < self.ttl:
+                self.stats['hits'] += 1
+                return self.value
+            if self._usable(now):
+                self.stats['stale_hits'] += 1
+                if not self.refreshing and now >= self.retry_at:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh, daemon=True).start()
+                return self.value
+            self.stats['misses'] += 1
+            if self.refreshing:
+                # Someone else is already fetching - wait for their result
+                self.refreshed.wait(timeout=10)
+                if self._usable(time.monotonic()):
+                    return self.value
+                raise self.last_error or RuntimeError('Failed to fetch prices')
+            if now < self.retry_at:
+                raise self.last_error or RuntimeError('Failed to fetch prices')
+            self.refreshing = True
+        self._refresh()
+        with self.lock:
+            if self._usable(time.monotonic()):
+                return self.value
+            raise self.last_error or RuntimeError('Failed to fetch prices')
+
+    def _refresh(self):
+        started = time.monotonic()
+        value, error = None, None
+        try:
+            value = self.loader()
+        except Exception as e:
+            error = e
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self.lock:
+            self.refreshing = False
+            self.stats['refreshes'] += 1
+            self.stats['last_refresh_ms'] = round(elapsed_ms, 1)
+            self.stats['total_refresh_ms'] += elapsed_ms
+            if error is None:
+                self.value = value
+                self.fetched_at = time.monotonic()
+                self.last_error = None
+            else:
+                # Back off so an upstream outage costs one call per ttl, not one per request
+                self.stats['errors'] += 1
+                self.last_error = error
+                self.retry_at = time.monotonic() + min(self.ttl, 5)
+            self.refreshed.notify_all()
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+            stats['hit_rate'] = round((stats['hits'] + stats['stale_hits']) / lookups, 4) if lookups else None
+            stats['avg_refresh_ms'] = round(stats['total_refresh_ms'] / stats['refreshes'], 1) if stats['refreshes'] else None
+            stats['total_refresh_ms'] = round(stats['total_refresh_ms'], 1)
+            stats['age_seconds'] = round(time.monotonic() - self.fetched_at, 1) if self.value is not None else None
+            stats['ttl'] = self.ttl
+            stats['max_stale'] = self.max_stale
+            stats['last_error'] = str(self.last_error) if self.last_error else None
+            return stats
+
+# Price history
+# Rollup bucket width and how long each granularity is kept (None = forever)
+PRICE_INTERVALS = {'1m': 60, '1h': 3600, '1d': 86400}
+PRICE_ROLLUP_RETENTION = {'1m': 30 * 86400, '1h': 400 * 86400, '1d': None}
+PRICE_TICK_RETENTION = int(os.environ.get('PRICE_TICK_RETENTION_DAYS', 7)) * 86400
+PRICE_HISTORY_MAX_POINTS = 1000
+
+def record_price_ticks(conn, prices, ts):
+    """Store one tick per coin and fold it into every rollup bucket it falls in."""
+    conn.executemany('INSERT OR REPLACE INTO price_ticks (coin, ts, price) VALUES (?, ?, ?)',
+                     [(coin, ts, p['price']) for coin, p in prices.items()])
+    conn.executemany(
+        'INSERT INTO price_rollups (coin, interval, bucket, open, high, low, close) VALUES (?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(coin, interval, bucket) DO UPDATE SET high = max(high, excluded.high), '
+        'low = min(low, excluded.low), close = excluded.close, samples = samples + 1',
+        [(coin, name, ts - ts % width, p['price'], p['price'], p['price'], p['price'])
+         for coin, p in prices.items() for name, width in PRICE_INTERVALS.items()]
+    )
+
+def compact_price_history(conn):
+    """Drop raw ticks and fine-grained rollups past their retention window."""
+    now = int(time.time())
+    # Per coin, so each delete is a range on the (coin, ts) primary key
+    conn.executemany('DELETE FROM price_ticks WHERE coin = ? AND ts < ?',
+                     [(coin, now - PRICE_TICK_RETENTION) for coin in PRICE_COINS])
+    for name, keep in PRICE_ROLLUP_RETENTION.items():
+        if keep is not None:
+            conn.execute('DELETE FROM price_rollups WHERE interval = ? AND bucket < ?', (name, now - keep))
+    conn.commit()
+
+def parse_history_time(value, default):
+    if not value:
+        return default
+    if value.lstrip('-').isdigit():
+        return int(value)
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)  # ticks are stored in UTC
+    return int(moment.timestamp())
+
+@app.route('/api/price-history/<coin>')
+def get_price_history(coin):
+    if coin not in PRICE_COINS:
+        return jsonify({'error': 'Unknown coin'}), 404
+    interval = request.args.get('interval', '1h')
+    if interval not in PRICE_INTERVALS:
+        return jsonify({'error': 'interval must be one of ' + ', '.join(PRICE_INTERVALS)}), 400
+    width = PRICE_INTERVALS[interval]
+    try:
+        end = parse_history_time(request.args.get('to'), int(time.time()))
+        start = parse_history_time(request.args.get('from'), end - width * PRICE_HISTORY_MAX_POINTS)
+    except ValueError:
+        return jsonify({'error': 'from/to must be unix seconds or ISO-8601'}), 400
+    db = get_db()
+    # Newest points first, so a range wider than the cap keeps its most recent end
+    rows = db.execute(
+        'SELECT bucket, open, high, low, close FROM price_rollups '
+        'WHERE coin = ? AND interval = ? AND bucket BETWEEN ? AND ? ORDER BY bucket DESC LIMIT ?',
+        (coin, interval, start - start % width, end, PRICE_HISTORY_MAX_POINTS + 1)
+    ).fetchall()
+    truncated = len(rows) > PRICE_HISTORY_MAX_POINTS
+    rows = rows[:PRICE_HISTORY_MAX_POINTS][::-1]
+    return jsonify({
+        'coin': coin,
+        'interval': interval,
+        'points': [{'t': r['bucket'], 'o': r['open'], 'h': r['high'], 'l': r['low'], 'c': r['close']} for r in rows],
+        'truncated': truncated,
+        # Pass as ?to= (keeping ?from=) to fetch the older points
+        'older_to': rows[0]['bucket'] - 1 if truncated else None,
+    })
+
+# Background price poller
+def acquire_lease(conn, name, holder, ttl):
+    """Take or renew the named lease. Returns True if `holder` owns it afterwards."""
+    now = time.time()
+    cur = conn.execute(
+        'INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) '
+        'ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at '
+        'WHERE leases.holder = excluded.holder OR leases.expires_at < ?',
+        (name, holder, now + ttl, now)
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+def publish_price_snapshot(conn, prices):
+    now = time.time()
+    conn.execute('INSERT OR REPLACE INTO price_snapshots (id, data, fetched_at) VALUES (1, ?, ?)',
+                 (json.dumps(prices), now))
+    record_price_ticks(conn, prices, int(now))
+    conn.commit()
+
+def refresh_prices(conn=None):
+    """Fetch from CoinGecko and publish the snapshot plus history ticks."""
+    prices = fetch_crypto_prices()
+    own = conn is None
+    if own:
+        conn = connect_db()
+    try:
+        publish_price_snapshot(conn, prices)
+    finally:
+        if own:
+            conn.close()
+    return prices
+
+def load_latest_prices():
+    """Read the snapshot published by the poller, fetching directly only if none exists yet."""
+    conn = connect_db()
+    try:
+        row = conn.execute('SELECT data, fetched_at FROM price_snapshots WHERE id = 1').fetchone()
+        if row is None:
+            return refresh_prices(conn)
+    finally:
+        conn.close()
+    if time.time() - row[1] > PRICE_CACHE_MAX_STALE:
+        raise RuntimeError('Failed to fetch prices')
+    return json.loads(row[0])
+
+def price_poller_loop(holder):
+    conn = connect_db()
+    last_compaction = 0.0
+    while True:
+        try:
+            # Lease outlives a couple of missed polls so a slow fetch doesn't hand over leadership
+            if acquire_lease(conn, 'price_poller', holder, PRICE_POLL_INTERVAL * 3):
+                fire_triggers(conn, symbol_marks(refresh_prices(conn)))
+                if time.time() - last_compaction > 3600:
+                    compact_price_history(conn)
+                    last_compaction = time.time()
+        except Exception as e:
+            app.logger.warning('Price poller: %s', e)
+        time.sleep(PRICE_POLL_INTERVAL)
+
+# Periodic jobs. Every process runs the scheduler loop, but a job only runs in the process
+# that takes its lease (`job:<name>`), and only once its last finished run in job_runs is
+# a full interval old - so each run happens once across all workers. The lease is short and
+# renewed while the job runs, so a dead leader is replaced within a few ticks.
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER', '1') == '1'
+SCHEDULER_TICK = float(os.environ.get('SCHEDULER_TICK', 15))
+JOB_LEASE_TTL = SCHEDULER_TICK * 4
+JOB_HISTORY_KEEP = int(os.environ.get('JOB_HISTORY_KEEP', 500))
+SUBSCRIPTION_EXPIRY_BATCH = 200
+
+JOBS = {}
+
+def scheduled(name, every, jitter=0.1):
+    """Register fn(conn) to run every `every` ('10m', '6h', '1d'), delayed by up to jitter*every."""
+    def register(fn):
+        JOBS[name] = {'name': name, 'every': parse_duration(every), 'jitter': jitter, 'fn': fn}
+        return fn
+    return register
+
+@scheduled('expire-subscriptions', '10m')
+def expire_subscriptions(conn):
+    """End subscriptions past ends_at, paying out like an admin completion, in short batches."""
+    expired = 0
+    while True:
+        with balance_transaction(conn):
+            due = conn.execute("SELECT * FROM subscriptions WHERE status = 'Active' AND ends_at <= datetime('now') "
+                               'ORDER BY ends_at LIMIT ?', (SUBSCRIPTION_EXPIRY_BATCH,)).fetchall()
+            for sub in due:
+                total = sub['amount'] + sub['earnings']
+                set_status(conn, 'subscriptions', sub['id'], 'Active', 'Expired')
+                credit_balance(conn, sub['user_id'], total, 'subscriptions', sub['id'], profit=sub['earnings'])
+                log_activity(conn, sub['user_id'], 'Plan Subscribed',
+                             f'Your {sub["plan"]} plan ended. Earnings: ${sub["earnings"]:.2f} credited to balance.', total)
+        expired += len(due)
+        if len(due) < SUBSCRIPTION_EXPIRY_BATCH:
+            return {'expired': expired}
+
+@scheduled('expire-trades', '1m')
+def expire_trades_job(conn):
+    return {'expired': expire_trades(conn, mark_prices())}
+
+@scheduled('optimize', '6h')
+def optimize_database(conn):
+    conn.execute('PRAGMA optimize')
+
+@scheduled('archive-activity', '1d')
+def archive_activity_job(conn):
+    return archive_activity(conn)
+
+def run_job(conn, job, holder):
+    """Run one job now, recording it in job_runs. Returns the finished run row."""
+    run_id = conn.execute('INSERT INTO job_runs (job, holder, started_at) VALUES (?, ?, ?)',
+                          (job['name'], holder, time.time())).lastrowid
+    conn.commit()
+    started = time.monotonic()
+    try:
+        result, status = job['fn'](conn), 'ok'
+    except Exception as e:
+        app.logger.warning('Job %s failed: %s', job['name'], e)
+        result, status = str(e), 'error'
+    conn.execute('UPDATE job_runs SET duration_ms = ?, finished_at = ?, status = ?, result = ? WHERE id = ?',
+                 (round((time.monotonic() - started) * 1000, 1), time.time(), status,
+                  None if result is None else json.dumps(result, default=str), run_id))
+    conn.execute('DELETE FROM job_runs WHERE job = ? AND id <= '
+                 '(SELECT id FROM job_runs WHERE job = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                 (job['name'], job['name'], JOB_HISTORY_KEEP))
+    conn.commit()
+    return conn.execute('SELECT * FROM job_runs WHERE id = ?', (run_id,)).fetchone()
+
+@contextmanager
+def renewing_lease(name, holder, ttl):
+    """Keep renewing a lease we hold, from a side thread and connection, until the block exits."""
+    done = threading.Event()
+
+    def renew():
+        conn = connect_db()
+        try:
+            while not done.wait(ttl / 3):
+                if not acquire_lease(conn, name, holder, ttl):
+                    app.logger.warning('Lease %s was taken over while %s held it', name, holder)
+        except sqlite3.Error as e:
+            app.logger.warning('Lease %s renewal: %s', name, e)
+        finally:
+            conn.close()
+
+    renewer = threading.Thread(target=renew, daemon=True, name=f'lease-{name}')
+    renewer.start()
+    try:
+        yield
+    finally:
+        done.set()
+        renewer.join()
+
+def job_due_at(conn, job, now):
+    last = conn.execute('SELECT MAX(finished_at) FROM job_runs WHERE job = ?', (job['name'],)).fetchone()[0]
+    return last + job['every'] if last is not None else now
+
+def run_due_jobs(conn, holder, next_check):
+    """Run every job that is due and whose lease we get; next_check is this process's backoff."""
+    for job in JOBS.values():
+        now = time.time()
+        if now < next_check.get(job['name'], 0):
+            continue
+        due_at = job_due_at(conn, job, now)
+        if now >= due_at:
+            if not acquire_lease(conn, 'job:' + job['name'], holder, JOB_LEASE_TTL):
+                # Another process is running it (or just did); look again once its lease could lapse
+                lease = conn.execute('SELECT expires_at FROM leases WHERE name = ?', ('job:' + job['name'],)).fetchone()
+                next_check[job['name']] = max(now + SCHEDULER_TICK, lease['expires_at'] if lease else 0)
+                continue
+            # Re-read under the lease: the previous holder may have finished a run meanwhile
+            due_at = job_due_at(conn, job, now)
+            if now >= due_at:
+                with renewing_lease('job:' + job['name'], holder, JOB_LEASE_TTL):
+                    run_job(conn, job, holder)
+                due_at = time.time() + job['every']
+        next_check[job['name']] = due_at + random.uniform(0, job['jitter'] * job['every'])
+
+def scheduler_loop(holder):
+    conn = connect_db()
+    next_check = {}
+    while True:
+        try:
+            run_due_jobs(conn, holder, next_check)
+        except Exception as e:
+            app.logger.warning('Scheduler: %s', e)
+        time.sleep(SCHEDULER_TICK)
+
+def job_metrics(conn):
+    """Per-job timing and outcome counts over the recorded run history."""
+    metrics = {}
+    for name, job in JOBS.items():
+        row = conn.execute(
+            "SELECT COUNT(*) AS runs, SUM(status = 'error') AS errors, AVG(duration_ms) AS avg_ms, "
+            'MAX(duration_ms) AS max_ms FROM job_runs WHERE job = ?', (name,)).fetchone()
+        last = conn.execute('SELECT * FROM job_runs WHERE job = ? ORDER BY id DESC LIMIT 1', (name,)).fetchone()
+        lease = conn.execute('SELECT holder, expires_at FROM leases WHERE name = ?', ('job:' + name,)).fetchone()
+        metrics[name] = {'every_seconds': job['every'], 'runs': row['runs'], 'errors': row['errors'] or 0,
+                         'avg_ms': round(row['avg_ms'], 1) if row['avg_ms'] is not None else None,
+                         'max_ms': row['max_ms'], 'last_run': dict(last) if last else None,
+                         'leader': lease['holder'] if lease else None}
+    return metrics
+
+@app.cli.command('run-job')
+@click.argument('name', type=click.Choice(sorted(JOBS)))
+def run_job_command(name):
+    """Run a scheduled job now and record it in job_runs."""
+    conn = connect_db()
+    try:
+        run = run_job(conn, JOBS[name], f'cli:{os.getpid()}')
+        print(f'{name}: {run["status"]} in {run["duration_ms"]} ms {run["result"] or ""}')
+    finally:
+        conn.close()
+
+_background_pid = None
+
+@app.before_request
+def start_background_workers():
+    # Threads don't survive a fork, so start them lazily in each serving process
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    _background_pid = os.getpid()
+    holder = f'{socket.gethostname()}:{os.getpid()}'
+    if PRICE_POLLER_ENABLED:
+        threading.Thread(target=price_poller_loop, args=(holder,), daemon=True, name='price-poller').start()
+    if SCHEDULER_ENABLED:
+        threading.Thread(target=scheduler_loop, args=(holder,), daemon=True, name='scheduler').start()
+
+price_cache = PriceCache(load_latest_prices if PRICE_POLLER_ENABLED else refresh_prices,
+                         PRICE_CACHE_TTL, PRICE_CACHE_MAX_STALE)
+
 # Crypto price API
 @app.route('/api/crypto-prices')
 def get_crypto_prices():
     try:
-        response = requests.get(
-            'https://api.coingecko.com/api/v3/simple/price',
-            params={
-                'ids': 'bitcoin,ethereum,tether,litecoin,solana,ripple,dogecoin,cardano',
-                'vs_currencies': 'usd',
-                'include_24hr_change': 'true'
-            },
-            timeout=5
-        )
-        if response.status_code == 200:
-            data = response.json()
-            return jsonify({
-                'bitcoin': {
-                    'price': data['bitcoin']['usd'],
-                    'change': data['bitcoin']['usd_24h_change']
-                },
-                'ethereum': {
-                    'price': data['ethereum']['usd'],
-                    'change': data['ethereum']['usd_24h_change']
-                },
-                'tether': {
-                    'price': data['tether']['usd'],
-                    'change': data['tether']['usd_24h_change']
-                },
-                'litecoin': {
-                    'price': data['litecoin']['usd'],
-                    'change': data['litecoin']['usd_24h_change']
-                },
-                'solana': {
-                    'price': data['solana']['usd'],
-                    'change': data['solana']['usd_24h_change']
-                },
-                'ripple': {
-                    'price': data['ripple']['usd'],
-                    'change': data['ripple']['usd_24h_change']
-                },
-                'dogecoin': {
-                    'price': data['dogecoin']['usd'],
-                    'change': data['dogecoin']['usd_24h_change']
-                },
-                'cardano': {
-                    'price': data['cardano']['usd'],
-                    'change': data['cardano']['usd_24h_change']
-                }
-            })
-        else:
-            return jsonify({'error': 'Failed to fetch prices'}), 500
+        return jsonify(price_cache.get())
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/price-cache')
+@admin_required
+def admin_price_cache_stats():
+    return jsonify(price_cache.snapshot())
+
+@app.route('/api/admin/account-cache')
+@admin_required
+def admin_account_cache_stats():
+    return jsonify(account_cache.snapshot())
+
+@app.route('/api/admin/triggers')
+@admin_required
+def admin_trigger_stats():
+    return jsonify(trigger_book.snapshot())
+
+@app.route('/api/admin/jobs')
+@admin_required
+def admin_job_stats():
+    return jsonify(job_metrics(get_db()))
+
+@app.route('/api/admin/profile')
+@admin_required
+def admin_profile_stats():
+    return jsonify(request_profiler.snapshot())
+
+@app.route('/api/admin/activity-writer')
+@admin_required
+def admin_activity_writer_stats():
+    return jsonify(activity_writer.snapshot())
+
+# Mark-to-market valuation of open trades. Prices are bound into the query as a
+# marks(symbol, price) table, so SQLite values every open row in one set-based pass.
+# Trades without an entry price or a market price (stocks) have no unrealized P&L.
+SYMBOL_COINS = {'BTC': 'bitcoin', 'ETH': 'ethereum', 'SOL': 'solana', 'XRP': 'ripple',
+                'LTC': 'litecoin', 'DOGE': 'dogecoin', 'USDT': 'tether', 'ADA': 'cardano'}
+
+UNREALIZED_PNL_SQL = ("CASE WHEN marks.price IS NULL OR t.entry_price IS NULL THEN NULL "
+                      "WHEN t.trade_type = 'Sell' THEN t.amount * (t.entry_price - marks.price) / t.entry_price "
+                      "ELSE t.amount * (marks.price - t.entry_price) / t.entry_price END")
+
+def symbol_marks(prices):
+    return {symbol: prices[coin]['price'] for symbol, coin in SYMBOL_COINS.items()
+            if coin in prices and prices[coin]['price']}
+
+def mark_prices():
+    """{symbol: price} from the price cache, or {} when prices are unavailable."""
+    try:
+        return symbol_marks(price_cache.get())
+    except Exception:
+        return {}
+
+def position_pnl(trade, price):
+    """P&L of closing `trade` at `price`; flat when either price is unknown."""
+    if price is None or not trade['entry_price']:
+        return 0.0
+    move = (price - trade['entry_price']) / trade['entry_price']
+    return round(trade['amount'] * (-move if trade['trade_type'] == 'Sell' else move), 2)
+
+def marks_cte(marks):
+    if not marks:
+        return 'WITH marks(symbol, price) AS (SELECT NULL, NULL WHERE 0) ', []
+    rows = ', '.join('(?, ?)' for _ in marks)
+    return f'WITH marks(symbol, price) AS (VALUES {rows}) ', [v for item in marks.items() for v in item]
+
+def value_open_trades(db, marks, where=(), params=()):
+    """Open trades with mark_price and unrealized_pnl columns, newest first."""
+    cte, args = marks_cte(marks)
+    clause = ' AND '.join(("t.status = 'Open'",) + tuple(where))
+    return db.execute(cte + f'SELECT t.*, marks.price AS mark_price, {UNREALIZED_PNL_SQL} AS unrealized_pnl '
+                      f'FROM trades t LEFT JOIN marks ON marks.symbol = t.symbol WHERE {clause} '
+                      'ORDER BY t.created_at DESC', args + list(params)).fetchall()
+
+def open_exposure(db, marks):
+    """Open positions aggregated per symbol and side, with totals."""
+    cte, args = marks_cte(marks)
+    rows = db.execute(cte + f'''
+        SELECT t.symbol, t.trade_type, COUNT(*) AS trades, SUM(t.amount) AS notional,
+               SUM(t.amount / t.entry_price) AS units,
+               SUM(CASE WHEN t.entry_price IS NOT NULL THEN t.amount END) / SUM(t.amount / t.entry_price) AS avg_entry,
+               MAX(marks.price) AS mark_price, SUM({UNREALIZED_PNL_SQL}) AS unrealized_pnl,
+               COUNT(*) - COUNT(marks.price * t.entry_price) AS unpriced
+        FROM trades t LEFT JOIN marks ON marks.symbol = t.symbol
+        WHERE t.status = 'Open'
+        GROUP BY t.symbol, t.trade_type''', args).fetchall()
+    positions = sorted((dict(r) for r in rows), key=lambda r: r['notional'], reverse=True)
+    return {'positions': positions,
+            'trades': sum(p['trades'] for p in positions),
+            'notional': sum(p['notional'] for p in positions),
+            'unrealized_pnl': sum(p['unrealized_pnl'] or 0 for p in positions),
+            'unpriced': sum(p['unpriced'] for p in positions)}
+
+def override_exit_price(trade, pnl):
+    """The exit price at which `trade` would have made `pnl`; None without an entry price."""
+    if not trade['entry_price']:
+        return None
+    move = pnl / trade['amount']
+    return trade['entry_price'] * (1 - move if trade['trade_type'] == 'Sell' else 1 + move)
+
+def trade_mark(db, trade_id):
+    """(mark_price, unrealized_pnl) for one open trade; Nones when it can't be marked."""
+    rows = value_open_trades(db, mark_prices(), ('t.id = ?',), (trade_id,))
+    if not rows or rows[0]['unrealized_pnl'] is None:
+        return None, None
+    return rows[0]['mark_price'], round(rows[0]['unrealized_pnl'], 2)
+
+CLOSE_BATCH_SIZE = 500
+
+def close_trades(db, exits):
+    """Close open trades in one batch; call inside balance_transaction().
+
+    `exits` maps trade id -> (exit_price, reason). Trades that are no longer open are
+    skipped. Returns [(trade, pnl)] for the trades actually closed.
+    """
+    ids = list(exits)
+    closed = []
+    for start in range(0, len(ids), CLOSE_BATCH_SIZE):
+        chunk = ids[start:start + CLOSE_BATCH_SIZE]
+        rows = db.execute(f"SELECT * FROM trades WHERE id IN ({','.join('?' * len(chunk))}) AND status = 'Open'",
+                          chunk).fetchall()
+        closed += [(row, position_pnl(row, exits[row['id']][0])) for row in rows]
+    if not closed:
+        return closed
+    db.executemany("UPDATE trades SET status = 'Closed', profit_loss = ?, exit_price = ? WHERE id = ? AND status = 'Open'",
+                   [(pnl, exits[row['id']][0], row['id']) for row, pnl in closed])
+    db.executemany('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?',
+                   [(row['amount'] + pnl, max(pnl, 0), row['user_id']) for row, pnl in closed])
+    db.executemany("INSERT INTO ledger_entries (user_id, account, ref_id, balance, profit) VALUES (?, 'trades', ?, ?, ?)",
+                   [(row['user_id'], row['id'], row['amount'] + pnl, max(pnl, 0)) for row, pnl in closed])
+    activity_writer.log_many(db, [(row['user_id'], 'Trade Closed',
+                                   f'{exits[row["id"]][1]}: your {row["trade_type"]} trade on {row["symbol"]} was closed. '
+                                   f'P&L: ${pnl:+.2f}', row['amount'] + pnl) for row, pnl in closed])
+    touch_account(*{row['user_id'] for row, _ in closed})
+    trigger_book.discard(*ids)
+    return closed
+
+# Stop-loss / take-profit triggers. Levels are prices: a Buy stops out when the price falls
+# to its stop_loss and takes profit when it rises to its take_profit; a Sell is the mirror
+# image. The process holding the price_poller lease keeps the book and fires it after each
+# tick. Trades closed by hand in other processes leave stale entries behind, which close_trades
+# skips and the periodic full reload drops.
+TRIGGER_RELOAD_INTERVAL = float(os.environ.get('TRIGGER_RELOAD_INTERVAL', 3600))
+
+class TriggerBook:
+    """Per-symbol heaps of SL/TP levels for open trades.
+
+    `rising` is a min-heap of levels that fire once the price climbs to them (Buy take-profit,
+    Sell stop-loss); `falling` is a max-heap of levels that fire once it drops to them. A tick
+    pops only the crossed levels - O(k log n) for k fired triggers - instead of scanning every
+    open trade. Removal is lazy: entries for trades no longer in `live` are skipped.
+    """
+
+    def __init__(self, reload_interval):
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.rising = {}
+        self.falling = {}
+        self.live = set()
+        self.last_id = 0
+        self.loaded_at = None
+        self.stats = {'loads': 0, 'ticks': 0, 'fired': 0, 'last_tick_ms': None}
+
+    def _add(self, trade):
+        rises = trade['trade_type'] == 'Sell'  # a Sell's stop sits above the price, a Buy's below
+        for level, reason, rising in ((trade['stop_loss'], 'Stop loss', rises),
+                                      (trade['take_profit'], 'Take profit', not rises)):
+            if level is None:
+                continue
+            if rising:
+                heapq.heappush(self.rising.setdefault(trade['symbol'], []), (level, trade['id'], reason))
+            else:
+                heapq.heappush(self.falling.setdefault(trade['symbol'], []), (-level, trade['id'], reason))
+        self.live.add(trade['id'])
+
+    def load(self, conn):
+        """Pick up trades opened since the last load; rebuild from scratch when due."""
+        sql = ('SELECT id, symbol, trade_type, stop_loss, take_profit FROM trades '
+               "WHERE id > ? AND status = 'Open' AND (stop_loss IS NOT NULL OR take_profit IS NOT NULL)")
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval:
+                self.rising, self.falling, self.live, self.last_id = {}, {}, set(), 0
+                self.loaded_at = time.monotonic()
+                self.stats['loads'] += 1
+            last_id = self.last_id
+        rows = conn.execute(sql, (last_id,)).fetchall()
+        with self.lock:
+            for row in rows:
+                self._add(row)
+                self.last_id = max(self.last_id, row['id'])
+
+    def crossed(self, marks):
+        """Pop every level the marks have reached; returns {trade_id: (price, reason)}."""
+        fired = {}
+        with self.lock:
+            for symbol, price in marks.items():
+                heap = self.rising.get(symbol, [])
+                while heap and heap[0][0] <= price:
+                    _, trade_id, reason = heapq.heappop(heap)
+                    if trade_id in self.live:
+                        fired[trade_id] = (price, reason)
+                        self.live.discard(trade_id)
+                heap = self.falling.get(symbol, [])
+                while heap and -heap[0][0] >= price:
+                    _, trade_id, reason = heapq.heappop(heap)
+                    if trade_id in self.live:
+                        fired[trade_id] = (price, reason)
+                        self.live.discard(trade_id)
+        return fired
+
+    def discard(self, *trade_ids):
+        with self.lock:
+            self.live.difference_update(trade_ids)
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['live'] = len(self.live)
+            stats['levels'] = sum(len(h) for h in self.rising.values()) + sum(len(h) for h in self.falling.values())
+            stats['age_seconds'] = round(time.monotonic() - self.loaded_at, 1) if self.loaded_at is not None else None
+            return stats
+
+trigger_book = TriggerBook(TRIGGER_RELOAD_INTERVAL)
+
+def fire_triggers(conn, marks):
+    """Close every open trade whose SL/TP the marks have crossed. Returns the number closed."""
+    started = time.monotonic()
+    trigger_book.load(conn)
+    fired = trigger_book.crossed(marks)
+    closed = []
+    if fired:
+        try:
+            with balance_transaction(conn):
+                closed = close_trades(conn, fired)
+        except Exception:
+            # The popped levels are gone from the heaps; rebuild on the next tick
+            trigger_book.loaded_at = None
+            raise
+    with trigger_book.lock:
+        trigger_book.stats['ticks'] += 1
+        trigger_book.stats['fired'] += len(closed)
+        trigger_book.stats['last_tick_ms'] = round((time.monotonic() - started) * 1000, 2)
+    return len(closed)
+
+# Duration expiry, run every minute by the scheduler. Due trades are found through the (status, expires_at) index and closed
+# in batches of EXPIRY_BATCH_SIZE, one short write transaction each, so a backlog never
+# holds the write lock for long and the work tracks the number of due trades only.
+EXPIRY_BATCH_SIZE = int(os.environ.get('EXPIRY_BATCH_SIZE', 200))
+EXPIRY_MAX_BATCHES = int(os.environ.get('EXPIRY_MAX_BATCHES', 50))
+EXPIRY_BATCH_PAUSE = float(os.environ.get('EXPIRY_BATCH_PAUSE', 0.05))
+
+def expire_trades(conn, marks, batch_size=None, max_batches=None):
+    """Close trades whose duration has run out at the current marks. Returns the number closed."""
+    batch_size = batch_size or EXPIRY_BATCH_SIZE
+    expired = 0
+    for _ in range(max_batches or EXPIRY_MAX_BATCHES):
+        with balance_transaction(conn):
+            due = conn.execute("SELECT id, symbol FROM trades WHERE status = 'Open' AND expires_at <= datetime('now') "
+                               'ORDER BY expires_at LIMIT ?', (batch_size,)).fetchall()
+            closed = close_trades(conn, {row['id']: (marks.get(row['symbol']), 'Expired') for row in due})
+        expired += len(closed)
+        if len(due) < batch_size:
+            break
+        time.sleep(EXPIRY_BATCH_PAUSE)  # let request writers in between batches
+    return expired
+
+@app.cli.command('expire-trades')
+def expire_trades_command():
+    """Close every trade whose duration has run out."""
+    conn = connect_db()
+    try:
+        marks = {}
+        try:
+            marks = symbol_marks(load_latest_prices())
+        except Exception as e:
+            print(f'No prices ({e}); trades will close flat.')
+        total, closed = 0, None
+        while closed != 0:
+            closed = expire_trades(conn, marks)
+            total += closed
+        print(f'Expired {total} trades.')
+    finally:
+        conn.close()
+
+OPEN_TRADE_FIELDS = ('id', 'symbol', 'trade_type', 'amount', 'entry_price', 'mark_price', 'unrealized_pnl', 'created_at')
+
+@app.route('/api/trades/open')
+@login_required
+def api_open_trades():
+    rows = value_open_trades(get_db(), mark_prices(), ('t.user_id = ?',), (session['user_id'],))
+    return jsonify({'trades': [{k: r[k] for k in OPEN_TRADE_FIELDS} for r in rows],
+                    'unrealized_pnl': round(sum(r['unrealized_pnl'] or 0 for r in rows), 2)})
+
+@app.route('/admin/exposure')
+@admin_required
+def admin_exposure():
+    exposure = open_exposure(get_db(), mark_prices())
+    if wants_json():
+        return jsonify(exposure)
+    return render_template('admin/exposure.html', exposure=exposure)
+
 # Notifications API
+NOTIFICATION_ICONS = {
+    'Trade Opened': 'fa-chart-bar',
+    'Trade Closed': 'fa-check-circle',
+    'Copy Trade Started': 'fa-copy',
+    'Copy Trade Stopped': 'fa-stop-circle',
+    'Staking Started': 'fa-coins',
+    'Plan Subscribed': 'fa-server',
+    'Signal Purchased': 'fa-broadcast-tower',
+    'Deposit': 'fa-arrow-down',
+    'Withdrawal': 'fa-arrow-up',
+}
+NOTIFICATION_COLORS = {
+    'Trade Opened': 'blue',
+    'Trade Closed': 'green',
+    'Copy Trade Started': 'purple',
+    'Copy Trade Stopped': 'gray',
+    'Staking Started': 'yellow',
+    'Plan Subscribed': 'indigo',
+    'Signal Purchased': 'cyan',
+    'Deposit': 'green',
+    'Withdrawal': 'orange',
+}
+NOTIFICATION_FEED_SIZE = 20
+# Badge counts stop here; the UI shows "9+" anyway
+NOTIFICATION_UNREAD_CAP = 99
+
+def format_notification(a):
+    return {
+        'id': a['id'],
+        'type': a['activity_type'],
+        'description': a['description'],
+        'amount': a['amount'],
+        'created_at': a['created_at'][:16],
+        'icon': NOTIFICATION_ICONS.get(a['activity_type'], 'fa-bell'),
+        'color': NOTIFICATION_COLORS.get(a['activity_type'], 'blue')
+    }
+
+def parse_db_timestamp(value):
+    """SQLite CURRENT_TIMESTAMP text (UTC) -> aware datetime, or None."""
+    try:
+        return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def conditional_json(etag, last_modified, build):
+    """JSON response with validators; answers 304 without calling build() when the client is current."""
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = bool(last_modified and request.if_modified_since and request.if_modified_since >= last_modified)
+    resp = app.response_class(status=304) if fresh else jsonify(build())
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    # Browsers revalidate every poll and reuse their cached body on 304
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+def latest_activity(db, user_id):
+    return db.execute('SELECT id, created_at FROM trading_activity WHERE user_id = ? ORDER BY id DESC LIMIT 1',
+                      (user_id,)).fetchone()
+
 @app.route('/api/notifications')
 @login_required
 def get_notifications():
+    """Latest activity for the user, or only rows newer than ?since_id= when given."""
     db = get_db()
-    activities = db.execute(
-        'SELECT * FROM trading_activity WHERE user_id = ? ORDER BY created_at DESC LIMIT 20',
-        (session['user_id'],)
-    ).fetchall()
-    db.close()
-    notifs = []
-    icons = {
-        'Trade Opened': 'fa-chart-bar',
-        'Trade Closed': 'fa-check-circle',
-        'Copy Trade Started': 'fa-copy',
-        'Copy Trade Stopped': 'fa-stop-circle',
-        'Staking Started': 'fa-coins',
-        'Plan Subscribed': 'fa-server',
-        'Signal Purchased': 'fa-broadcast-tower',
-        'Deposit': 'fa-arrow-down',
-        'Withdrawal': 'fa-arrow-up',
-    }
-    colors = {
-        'Trade Opened': 'blue',
-        'Trade Closed': 'green',
-        'Copy Trade Started': 'purple',
-        'Copy Trade Stopped': 'gray',
-        'Staking Started': 'yellow',
-        'Plan Subscribed': 'indigo',
-        'Signal Purchased': 'cyan',
-        'Deposit': 'green',
-        'Withdrawal': 'orange',
-    }
-    for a in activities:
-        notifs.append({
-            'id': a['id'],
-            'type': a['activity_type'],
-            'description': a['description'],
-            'amount': a['amount'],
-            'created_at': a['created_at'][:16],
-            'icon': icons.get(a['activity_type'], 'fa-bell'),
-            'color': colors.get(a['activity_type'], 'blue')
-        })
-    return jsonify(notifs)
+    user_id = session['user_id']
+    since_id = request.args.get('since_id', 0, type=int)
+    latest = latest_activity(db, user_id)
+    # The body depends on since_id as well as the newest row, so both go in the validator
+    etag = f'u{user_id}-s{since_id}-{latest["id"] if latest else 0}'
+
+    def build():
+        activities = db.execute(
+            'SELECT * FROM trading_activity WHERE user_id = ? AND id > ? ORDER BY id DESC LIMIT ?',
+            (user_id, since_id, NOTIFICATION_FEED_SIZE)
+        ).fetchall()
+        return [format_notification(a) for a in activities]
+    return conditional_json(etag, parse_db_timestamp(latest['created_at']) if latest else None, build)
+
+@app.route('/api/notifications/unread')
+@login_required
+def get_unread_notification_count():
+    """Count of activity rows newer than ?since_id= (the newest id the client has seen)."""
+    db = get_db()
+    user_id = session['user_id']
+    since_id = request.args.get('since_id', 0, type=int)
+    latest = latest_activity(db, user_id)
+    etag = f'u{user_id}-s{since_id}-{latest["id"] if latest else 0}'
+
+    def build():
+        count = db.execute(
+            'SELECT COUNT(*) FROM (SELECT 1 FROM trading_activity WHERE user_id = ? AND id > ? LIMIT ?)',
+            (user_id, since_id, NOTIFICATION_UNREAD_CAP)
+        ).fetchone()[0]
+        return {'unread': count, 'latest_id': latest['id'] if latest else 0}
+    return conditional_json(etag, parse_db_timestamp(latest['created_at']) if latest else None, build)
 
 # Admin notifications API
 @app.route('/api/admin/notifications')
 @admin_required
 def get_admin_notifications():
     db = get_db()
+    return conditional_json(admin_notifications_etag(db), None, lambda: build_admin_notifications(db))
+
+def admin_notifications_etag(db):
+    # Fingerprint everything the feed depends on, so unchanged polls skip the joins
+    pending = db.execute(
+        "SELECT type, COUNT(*), MAX(id) FROM transactions "
+        "WHERE type IN ('Deposit', 'Withdrawal') AND status = 'Pending' GROUP BY type"
+    ).fetchall()
+    last_user = db.execute('SELECT MAX(id) FROM users').fetchone()[0]
+    return 'a-' + '-'.join(f'{r[0][0]}{r[1]}.{r[2]}' for r in pending) + f'-u{last_user}-{datetime.now(timezone.utc):%Y%m%d}'
+
+def build_admin_notifications(db):
     notifs = []
 
     # Pending deposits
@@ -429,19 +2260,150 @@ def get_admin_notifications():
             'color': 'green',
         })
 
-    db.close()
     notifs.sort(key=lambda x: x['created_at'], reverse=True)
-    return jsonify(notifs[:20])
+    return notifs[:NOTIFICATION_FEED_SIZE]
+
+# Server-Sent Events
+# One EventHub per process fans events out to every open /api/stream. A single
+# pump thread watches the database and price cache and publishes each change
+# once, so N open tabs cost one query per SSE_PUMP_INTERVAL rather than N polls.
+# Each stream parks on a queue, so run gunicorn with an async worker class
+# (gevent, see render.yaml) to avoid tying up one thread per idle connection.
+SSE_ENABLED = os.environ.get('SSE_ENABLED', '1') == '1'
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 500))
+SSE_PUMP_INTERVAL = float(os.environ.get('SSE_PUMP_INTERVAL', 2))
+SSE_HEARTBEAT = 15
+
+def sse_message(event, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event}\ndata: {json.dumps(data)}\n\n'
+
+class EventHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.clients = 0
+        self.pump = None
+
+    def subscribe(self, channels):
+        """Register a stream on `channels`. Returns its queue, or None when full."""
+        q = queue.Queue(maxsize=256)
+        with self.lock:
+            if self.clients >= SSE_MAX_CLIENTS:
+                return None
+            for channel in channels:
+                self.subscribers.setdefault(channel, set()).add(q)
+            self.clients += 1
+            if self.pump is None:
+                self.pump = threading.Thread(target=stream_pump, args=(self,), daemon=True, name='sse-pump')
+                self.pump.start()
+        return q
+
+    def unsubscribe(self, q, channels):
+        with self.lock:
+            for channel in channels:
+                subs = self.subscribers.get(channel)
+                if subs is not None:
+                    subs.discard(q)
+                    if not subs:
+                        del self.subscribers[channel]
+            self.clients -= 1
+
+    def has(self, channel):
+        return channel in self.subscribers
+
+    def publish(self, channel, event, data, event_id=None):
+        with self.lock:
+            targets = list(self.subscribers.get(channel, ()))
+        if not targets:
+            return
+        message = sse_message(event, data, event_id)
+        for q in targets:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass  # client isn't reading; it will resync from the REST endpoints
+
+    def stop_pump_if_idle(self):
+        with self.lock:
+            if self.clients == 0:
+                self.pump = None
+                return True
+        return False
+
+event_hub = EventHub()
+
+def stream_pump(hub):
+    conn = connect_db()
+    try:
+        last_activity_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM trading_activity').fetchone()[0]
+        last_prices = None
+        admin_tag = None
+        while not hub.stop_pump_if_idle():
+            try:
+                if hub.has('prices'):
+                    try:
+                        prices = price_cache.get()
+                    except Exception:
+                        prices = None
+                    if prices is not None and prices is not last_prices:
+                        hub.publish('prices', 'prices', prices)
+                        last_prices = prices
+                # Primary-key range scan over rows added since the last tick, across all users
+                rows = conn.execute('SELECT * FROM trading_activity WHERE id > ? ORDER BY id LIMIT 1000',
+                                    (last_activity_id,)).fetchall()
+                for row in rows:
+                    last_activity_id = row['id']
+                    hub.publish(f'user:{row["user_id"]}', 'notification', format_notification(row), row['id'])
+                if hub.has('admin'):
+                    tag = admin_notifications_etag(conn)
+                    if tag != admin_tag:
+                        hub.publish('admin', 'admin_notifications', build_admin_notifications(conn))
+                        admin_tag = tag
+            except Exception as e:
+                app.logger.warning('Stream pump: %s', e)
+            time.sleep(SSE_PUMP_INTERVAL)
+    finally:
+        conn.close()
+
+@app.route('/api/stream')
+def event_stream():
+    if not SSE_ENABLED:
+        return jsonify({'error': 'Streaming is disabled'}), 404
+    channels = ['prices']
+    if session.get('user_id'):
+        channels.append(f'user:{session["user_id"]}')
+    if session.get('is_admin'):
+        channels.append('admin')
+    q = event_hub.subscribe(channels)
+    if q is None:
+        return jsonify({'error': 'Too many open streams'}), 503
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            try:
+                yield sse_message('prices', price_cache.get())
+            except Exception:
+                pass
+            while True:
+                try:
+                    yield q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+        finally:
+            event_hub.unsubscribe(q, channels)
+
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Admin Wallet Management
 @app.route('/admin/wallets')
 @admin_required
 def admin_wallets():
-    migrate_db()  # ensure tables exist on every call
     db = get_db()
     wallets = db.execute('SELECT * FROM wallet_addresses ORDER BY id').fetchall()
     contact = db.execute('SELECT * FROM contact_info WHERE id=1').fetchone()
-    db.close()
     return render_template('admin/wallets.html', wallets=wallets, contact=contact)
 
 @app.route('/admin/wallets/add', methods=['POST'])
@@ -457,11 +2419,11 @@ def admin_add_wallet():
         try:
             db.execute('INSERT INTO wallet_addresses (coin_id,coin_name,symbol,icon,address) VALUES (?,?,?,?,?)',
                       (coin_id, coin_name, symbol, icon, address))
+            invalidate_reference(db, 'wallets')
             db.commit()
             flash(f'{coin_name} wallet added!', 'success')
         except:
             flash('Coin ID already exists. Use a unique ID.', 'error')
-        db.close()
     return redirect(url_for('admin_wallets'))
 
 @app.route('/admin/wallets/edit/<int:wallet_id>', methods=['POST'])
@@ -472,8 +2434,8 @@ def admin_edit_wallet(wallet_id):
               (request.form.get('coin_name'), request.form.get('symbol','').upper(),
                request.form.get('icon','₿'), request.form.get('address'),
                int(request.form.get('is_active', 1)), wallet_id))
+    invalidate_reference(db, 'wallets')
     db.commit()
-    db.close()
     flash('Wallet updated!', 'success')
     return redirect(url_for('admin_wallets'))
 
@@ -482,8 +2444,8 @@ def admin_edit_wallet(wallet_id):
 def admin_delete_wallet(wallet_id):
     db = get_db()
     db.execute('DELETE FROM wallet_addresses WHERE id=?', (wallet_id,))
+    invalidate_reference(db, 'wallets')
     db.commit()
-    db.close()
     flash('Wallet removed.', 'success')
     return redirect(url_for('admin_wallets'))
 
@@ -498,8 +2460,8 @@ def admin_update_contact():
     db = get_db()
     db.execute('UPDATE contact_info SET email=?, whatsapp=?, whatsapp_link=?, telegram=?, telegram_link=? WHERE id=1',
               (email, whatsapp, whatsapp_link, telegram, telegram_link))
+    invalidate_reference(db, 'contact')
     db.commit()
-    db.close()
     flash('Contact info updated!', 'success')
     return redirect(url_for('admin_wallets'))
 
@@ -538,7 +2500,6 @@ def login():
         # Check regular user
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE email = ?', (email,)).fetchone()
-        db.close()
         
         if user and user['password'] == hash_password(password):
             session['user_id'] = user['id']
@@ -577,8 +2538,6 @@ def register():
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
             flash('Email already exists!', 'error')
-        finally:
-            db.close()
     
     return render_template('register.html')
 
@@ -591,92 +2550,64 @@ def verify_email():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    
-    # Get recent transactions
-    transactions = db.execute(
-        'SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 5',
-        (session['user_id'],)
-    ).fetchall()
-    
-    # Get copy trades
-    copy_trades = db.execute(
-        'SELECT * FROM copy_trades WHERE user_id = ? ORDER BY created_at DESC',
-        (session['user_id'],)
-    ).fetchall()
-    
-    # Get recent activity
-    activities = db.execute(
-        'SELECT * FROM trading_activity WHERE user_id = ? ORDER BY created_at DESC LIMIT 10',
-        (session['user_id'],)
-    ).fetchall()
-    
-    db.close()
-    return render_template('dashboard.html', user=user, transactions=transactions, 
-                         copy_trades=copy_trades, activities=activities)
+    account = current_account(get_db())
+    return render_template('dashboard.html', user=account['user'], transactions=account['transactions'],
+                         copy_trades=account['copy_trades'], activities=account['activities'])
 
 @app.route('/copy-trading')
 @login_required
 def copy_trading():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    user = current_account(db)['user']
     copy_trades = db.execute(
         'SELECT * FROM copy_trades WHERE user_id = ?',
         (session['user_id'],)
     ).fetchall()
-    db.close()
     
-    # Top traders (sample data)
-    top_traders = [
-        {'name': 'Vivek Sharma', 'roi': 287.5, 'copiers': 1200, 'win_rate': 97.0, 'wins': 18003, 'losses': 556, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/32.jpg', 'country': 'India'},
-        {'name': 'Edo Martinez', 'roi': 245.8, 'copiers': 987, 'win_rate': 94.7, 'wins': 1892, 'losses': 120, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/44.jpg', 'country': 'Spain'},
-        {'name': 'W D Gann', 'roi': 399.8, 'copiers': 50, 'win_rate': 99.8, 'wins': 103, 'losses': 1, 'profit_share': 25, 'photo': 'https://randomuser.me/api/portraits/men/77.jpg', 'country': 'USA'},
-        {'name': 'Echo X', 'roi': 312.4, 'copiers': 2500, 'win_rate': 95.6, 'wins': 50218, 'losses': 180, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/22.jpg', 'country': 'Singapore'},
-        {'name': 'Coach JV', 'roi': 276.1, 'copiers': 820, 'win_rate': 98.3, 'wins': 8201, 'losses': 46, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/55.jpg', 'country': 'UK'},
-        {'name': 'Sarah Chen', 'roi': 334.2, 'copiers': 1650, 'win_rate': 96.2, 'wins': 22450, 'losses': 890, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/women/44.jpg', 'country': 'China'},
-        {'name': 'Marcus Webb', 'roi': 198.7, 'copiers': 430, 'win_rate': 92.1, 'wins': 4320, 'losses': 370, 'profit_share': 15, 'photo': 'https://randomuser.me/api/portraits/men/68.jpg', 'country': 'Australia'},
-        {'name': 'Yuki Tanaka', 'roi': 421.0, 'copiers': 3100, 'win_rate': 97.8, 'wins': 61003, 'losses': 210, 'profit_share': 20, 'photo': 'https://randomuser.me/api/portraits/men/9.jpg', 'country': 'Japan'},
-        {'name': 'Aisha Okafor', 'roi': 263.5, 'copiers': 780, 'win_rate': 93.4, 'wins': 7812, 'losses': 556, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/women/68.jpg', 'country': 'Nigeria'},
-        {'name': 'Viktor Petrov', 'roi': 357.9, 'copiers': 2200, 'win_rate': 96.9, 'wins': 38901, 'losses': 124, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/15.jpg', 'country': 'Russia'},
-        {'name': 'Liam O\'Brien', 'roi': 229.3, 'copiers': 560, 'win_rate': 91.8, 'wins': 5640, 'losses': 503, 'profit_share': 12, 'photo': 'https://randomuser.me/api/portraits/men/38.jpg', 'country': 'Ireland'},
-        {'name': 'Priya Nair', 'roi': 289.6, 'copiers': 1400, 'win_rate': 95.1, 'wins': 19230, 'losses': 990, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/women/25.jpg', 'country': 'India'},
-        {'name': 'Carlos Reyes', 'roi': 311.4, 'copiers': 1900, 'win_rate': 94.3, 'wins': 28400, 'losses': 1710, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/82.jpg', 'country': 'Mexico'},
-        {'name': 'Nadia Blanc', 'roi': 247.8, 'copiers': 670, 'win_rate': 93.7, 'wins': 8930, 'losses': 600, 'profit_share': 15, 'photo': 'https://randomuser.me/api/portraits/women/12.jpg', 'country': 'France'},
-        {'name': 'James Osei', 'roi': 378.2, 'copiers': 2800, 'win_rate': 98.1, 'wins': 44300, 'losses': 105, 'profit_share': 10, 'photo': 'https://randomuser.me/api/portraits/men/91.jpg', 'country': 'Ghana'},
-    ]
-    
-    return render_template('copy_trading.html', user=user, top_traders=top_traders, 
-                         copy_trades=copy_trades)
+    sort = request.args.get('sort', 'roi')
+    if sort not in TRADER_SORT_KEYS:
+        sort = 'roi'
+    country = request.args.get('country', '')
+    q = request.args.get('q', '').strip().lower()
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    ranking = get_trader_ranking()
+    traders = ranking['by'][sort]
+    if country or q:
+        traders = [t for t in traders
+                   if (not country or t['country'] == country) and (not q or q in t['name'].lower())]
+    total = len(traders)
+    pages = max((total + TRADERS_PER_PAGE - 1) // TRADERS_PER_PAGE, 1)
+    page = min(page, pages)
+    top_traders = traders[(page - 1) * TRADERS_PER_PAGE:page * TRADERS_PER_PAGE]
+
+    return render_template('copy_trading.html', user=user, top_traders=top_traders,
+                         copy_trades=copy_trades, total=total, page=page, pages=pages,
+                         sort=sort, country=country, q=request.args.get('q', ''),
+                         countries=ranking['countries'], sort_keys=TRADER_SORT_KEYS)
 
 @app.route('/start-copy-trade', methods=['POST'])
 @login_required
 def start_copy_trade():
     trader_name = request.form.get('trader_name')
-    amount = float(request.form.get('amount'))
+    amount = float(request.form.get('amount') or 0)
     
     db = get_db()
-    user = db.execute('SELECT balance FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    
-    if amount > user['balance']:
-        flash('Insufficient balance!', 'error')
-    else:
-        db.execute(
-            'INSERT INTO copy_trades (user_id, trader_name, amount) VALUES (?, ?, ?)',
-            (session['user_id'], trader_name, amount)
-        )
-        db.execute(
-            'UPDATE users SET balance = balance - ? WHERE id = ?',
-            (amount, session['user_id'])
-        )
-        db.execute(
-            'INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?, ?, ?, ?)',
-            (session['user_id'], 'Copy Trade Started', f'Started copying {trader_name}', amount)
-        )
-        db.commit()
+    if amount <= 0:
+        flash('Invalid amount.', 'error')
+        return redirect(url_for('copy_trading'))
+    try:
+        with balance_transaction(db):
+            cur = db.execute(
+                'INSERT INTO copy_trades (user_id, trader_name, amount) VALUES (?, ?, ?)',
+                (session['user_id'], trader_name, amount)
+            )
+            debit_balance(db, session['user_id'], amount, 'copy_trades', cur.lastrowid)
+            log_activity(db, session['user_id'], 'Copy Trade Started', f'Started copying {trader_name}', amount)
         flash(f'Successfully started copying {trader_name} with ${amount}!', 'success')
+    except InsufficientBalance:
+        flash('Insufficient balance!', 'error')
     
-    db.close()
     return redirect(url_for('copy_trading'))
 
 @app.route('/stop-copy-trade/<int:trade_id>', methods=['POST'])
@@ -689,17 +2620,16 @@ def stop_copy_trade(trade_id):
     if trade:
         # Return investment plus profit
         total_return = trade['amount'] + trade['total_profit']
-        db.execute('UPDATE users SET balance = balance + ? WHERE id = ?', 
-                  (total_return, session['user_id']))
-        db.execute('UPDATE copy_trades SET status = ? WHERE id = ?', ('Stopped', trade_id))
-        db.execute(
-            'INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?, ?, ?, ?)',
-            (session['user_id'], 'Copy Trade Stopped', f'Stopped copying {trade["trader_name"]}', total_return)
-        )
-        db.commit()
-        flash(f'Copy trade stopped. ${total_return:.2f} returned to your balance.', 'success')
+        try:
+            with balance_transaction(db):
+                set_status(db, 'copy_trades', trade_id, 'Active', 'Stopped')
+                credit_balance(db, session['user_id'], total_return, 'copy_trades', trade_id)
+                log_activity(db, session['user_id'], 'Copy Trade Stopped',
+                             f'Stopped copying {trade["trader_name"]}', total_return)
+            flash(f'Copy trade stopped. ${total_return:.2f} returned to your balance.', 'success')
+        except StaleState:
+            flash('This copy trade has already been stopped.', 'error')
     
-    db.close()
     return redirect(url_for('copy_trading'))
 
 @app.route('/deposit', methods=['GET', 'POST'])
@@ -722,17 +2652,18 @@ def deposit():
         db = get_db()
         db.execute('INSERT INTO transactions (user_id, type, amount, crypto, status, proof_file) VALUES (?, ?, ?, ?, ?, ?)',
             (session['user_id'], 'Deposit', float(amount) if amount else 0, crypto, 'Pending', proof_filename))
-        db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-            (session['user_id'], 'Deposit', f'Deposit of ${amount} via {crypto.upper() if crypto else ""} submitted — awaiting confirmation.', float(amount) if amount else 0))
+        log_activity(db, session['user_id'], 'Deposit',
+            f'Deposit of ${amount} via {crypto.upper() if crypto else ""} submitted — awaiting confirmation.', float(amount) if amount else 0)
         db.commit()
-        db.close()
         flash(f'Deposit of ${amount} submitted! Our team will confirm your payment shortly.', 'success')
     db = get_db()
-    deposits = db.execute("SELECT * FROM transactions WHERE user_id = ? AND type = 'Deposit' ORDER BY created_at DESC", (session['user_id'],)).fetchall()
-    db.close()
+    deposits, next_cursor = history_page(db, 'transactions', session['user_id'], ["type = 'Deposit'"])
+    if wants_json():
+        return history_json(deposits, next_cursor)
     wallets = get_wallets()
     wallets_dict = {w['coin_id']: w['address'] for w in wallets}
-    return render_template('deposit.html', wallets=wallets_dict, wallet_list=wallets, deposits=deposits)
+    return render_template('deposit.html', wallets=wallets_dict, wallet_list=wallets, deposits=deposits,
+                           next_cursor=next_cursor)
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
@@ -744,36 +2675,38 @@ def uploaded_file(filename):
 @login_required
 def withdraw():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
     
     if request.method == 'POST':
-        amount = float(request.form.get('amount'))
+        amount = float(request.form.get('amount') or 0)
         crypto = request.form.get('crypto')
         wallet_address = request.form.get('wallet_address')
         
-        if amount > user['balance']:
-            flash('Insufficient balance!', 'error')
+        if amount <= 0:
+            flash('Invalid amount.', 'error')
         else:
-            db.execute('INSERT INTO transactions (user_id, type, amount, crypto, wallet_address, status) VALUES (?, ?, ?, ?, ?, ?)',
-                (session['user_id'], 'Withdrawal', amount, crypto, wallet_address, 'Pending'))
-            db.commit()
-            flash(f'Withdrawal request for ${amount} submitted!', 'success')
-    withdrawals = db.execute("SELECT * FROM transactions WHERE user_id = ? AND type = 'Withdrawal' ORDER BY created_at DESC", (session['user_id'],)).fetchall()
-    db.close()
+            try:
+                with balance_transaction(db):
+                    request_withdrawal(db, session['user_id'], amount, crypto, wallet_address)
+                flash(f'Withdrawal request for ${amount} submitted!', 'success')
+            except InsufficientBalance:
+                flash('Insufficient balance!', 'error')
+    user = current_account(db)['user']
+    withdrawals, next_cursor = history_page(db, 'transactions', session['user_id'], ["type = 'Withdrawal'"])
+    if wants_json():
+        return history_json(withdrawals, next_cursor)
     wallets = get_wallets()
     wallets_dict = {w['coin_id']: w['address'] for w in wallets}
-    return render_template('withdraw.html', user=user, wallets=wallets_dict, wallet_list=wallets, withdrawals=withdrawals)
+    return render_template('withdraw.html', user=user, wallets=wallets_dict, wallet_list=wallets,
+                           withdrawals=withdrawals, next_cursor=next_cursor)
 
 @app.route('/transactions')
 @login_required
 def transactions():
     db = get_db()
-    transactions = db.execute(
-        'SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC',
-        (session['user_id'],)
-    ).fetchall()
-    db.close()
-    return render_template('transactions.html', transactions=transactions)
+    transactions, next_cursor = history_page(db, 'transactions', session['user_id'])
+    if wants_json():
+        return history_json(transactions, next_cursor)
+    return render_template('transactions.html', transactions=transactions, next_cursor=next_cursor)
 
 @app.route('/logout')
 def logout():
@@ -782,13 +2715,37 @@ def logout():
     return redirect(url_for('index'))
 
 # Admin routes
+ADMIN_USER_SORTS = {'joined': 'created_at', 'balance': 'balance', 'profit': 'profit'}
+ADMIN_TOTALS_TTL = float(os.environ.get('ADMIN_TOTALS_TTL', 30))
+_admin_totals = {'value': None, 'at': 0.0}
+
+def get_user_totals(db):
+    """Platform-wide sums, aggregated in SQL and reused for ADMIN_TOTALS_TTL seconds."""
+    if _admin_totals['value'] is None or time.monotonic() - _admin_totals['at'] > ADMIN_TOTALS_TTL:
+        row = db.execute('SELECT COUNT(*) AS users, COALESCE(SUM(balance), 0) AS balance, '
+                         'COALESCE(SUM(profit), 0) AS profit, COALESCE(SUM(total_deposit), 0) AS deposits '
+                         'FROM users').fetchone()
+        _admin_totals.update(value=dict(row), at=time.monotonic())
+    return _admin_totals['value']
+
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
     db = get_db()
-    users = db.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
-    db.close()
-    return render_template('admin/dashboard.html', users=users)
+    sort = request.args.get('sort', 'joined')
+    if sort not in ADMIN_USER_SORTS:
+        sort = 'joined'
+    q = request.args.get('q', '').strip()
+    where, params = [], []
+    if q:
+        where.append('(email LIKE ? OR name LIKE ?)')
+        params += [q + '%', q + '%']
+    users, next_cursor = keyset_page(
+        db, 'SELECT id, name, email, balance, profit, created_at FROM users', where, params,
+        cursor=request.args.get('cursor'), sort=ADMIN_USER_SORTS[sort])
+    return render_template('admin/dashboard.html', users=users, totals=get_user_totals(db),
+                           sort=sort, sorts=ADMIN_USER_SORTS, q=q, next_cursor=next_cursor,
+                           is_first_page=not request.args.get('cursor'))
 
 @app.route('/admin/user/<int:user_id>', methods=['GET', 'POST'])
 @admin_required
@@ -801,22 +2758,22 @@ def admin_edit_user(user_id):
         total_deposit = request.form.get('total_deposit')
         total_withdrawal = request.form.get('total_withdrawal')
         
-        db.execute(
-            'UPDATE users SET balance = ?, profit = ?, total_deposit = ?, total_withdrawal = ? WHERE id = ?',
-            (balance, profit, total_deposit, total_withdrawal, user_id)
-        )
-        db.commit()
-        flash('User data updated successfully!', 'success')
+        try:
+            with balance_transaction(db):
+                adjust_balances(db, user_id, memo='Admin edit', balance=balance, profit=profit,
+                                total_deposit=total_deposit, total_withdrawal=total_withdrawal)
+            flash('User data updated successfully!', 'success')
+        except UnknownAccount:
+            flash('User not found.', 'error')
         return redirect(url_for('admin_dashboard'))
     
     user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    transactions = db.execute(
-        'SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC',
-        (user_id,)
-    ).fetchall()
-    db.close()
+    transactions, next_cursor = history_page(db, 'transactions', user_id)
+    if wants_json():
+        return history_json(transactions, next_cursor)
     
-    return render_template('admin/edit_user.html', user=user, transactions=transactions)
+    return render_template('admin/edit_user.html', user=user, transactions=transactions,
+                           next_cursor=next_cursor)
 
 @app.route('/admin/transaction/<int:transaction_id>/approve', methods=['POST'])
 @admin_required
@@ -824,42 +2781,123 @@ def admin_approve_transaction(transaction_id):
     db = get_db()
     transaction = db.execute('SELECT * FROM transactions WHERE id = ?', (transaction_id,)).fetchone()
 
-    if transaction:
-        db.execute('UPDATE transactions SET status = ? WHERE id = ?', ('Completed', transaction_id))
-
-        # Update user balance for deposits + send notification
-        if transaction['type'] == 'Deposit':
-            db.execute(
-                'UPDATE users SET balance = balance + ?, total_deposit = total_deposit + ? WHERE id = ?',
-                (transaction['amount'], transaction['amount'], transaction['user_id'])
-            )
-            db.execute(
-                'INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (transaction['user_id'], 'Deposit',
-                 f'Your deposit of ${transaction["amount"]:.2f} via {(transaction["crypto"] or "").upper()} has been confirmed and credited to your account! 🎉',
-                 transaction['amount'])
-            )
-
-        # Update user balance for withdrawals + send notification
-        elif transaction['type'] == 'Withdrawal':
-            db.execute(
-                'UPDATE users SET balance = balance - ?, total_withdrawal = total_withdrawal + ? WHERE id = ?',
-                (transaction['amount'], transaction['amount'], transaction['user_id'])
-            )
-            db.execute(
-                'INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (transaction['user_id'], 'Withdrawal',
-                 f'Your withdrawal of ${transaction["amount"]:.2f} has been approved and is being processed.',
-                 transaction['amount'])
-            )
-
-        db.commit()
+    if not transaction:
+        flash('Transaction not found.', 'error')
+        return redirect(url_for('admin_dashboard'))
+    with balance_transaction(db):
+        outcome = settle_transactions(db, [transaction_id], 'approve')[transaction_id]
+    if outcome == 'approved':
         flash(f'Transaction approved! User balance updated and notification sent.', 'success')
+    else:
+        flash(f'Transaction #{transaction_id} not approved: {outcome}.', 'error')
 
-    db.close()
     return redirect(url_for('admin_edit_user', user_id=transaction['user_id']))
 
 
+# Admin: pending deposits/withdrawals, settled in bulk
+SETTLE_BATCH_MAX = int(os.environ.get('SETTLE_BATCH_MAX', 500))
+
+def transaction_notice(tx, action):
+    amount = tx['amount']
+    if tx['type'] == 'Deposit':
+        if action == 'approve':
+            return f'Your deposit of ${amount:.2f} via {(tx["crypto"] or "").upper()} has been confirmed and credited to your account! 🎉'
+        return f'Your deposit of ${amount:.2f} could not be confirmed and was rejected.'
+    if action == 'approve':
+        return f'Your withdrawal of ${amount:.2f} has been approved and is being processed.'
+    return f'Your withdrawal of ${amount:.2f} was rejected. The funds remain in your balance.'
+
+def settle_transactions(db, ids, action):
+    """Approve or reject pending deposits/withdrawals; call inside balance_transaction().
+
+    Balance, ledger, status and notification writes each go out as one executemany.
+    Returns {id: outcome}: 'approved', 'rejected', 'not pending', 'not found' or
+    'insufficient balance' (a withdrawal the user's balance no longer covers).
+    """
+    ids = list(dict.fromkeys(ids))
+    placeholders = ','.join('?' * len(ids))
+    rows = db.execute(f'SELECT * FROM transactions WHERE id IN ({placeholders}) ORDER BY id', ids).fetchall()
+    results = dict.fromkeys(ids, 'not found')
+    pending = []
+    for row in rows:
+        if row['status'] == 'Pending' and row['type'] in ('Deposit', 'Withdrawal'):
+            pending.append(row)
+        else:
+            results[row['id']] = 'not pending'
+    settled = pending
+    if action == 'approve':
+        # We hold the write lock, so these balances can't move under us
+        user_ids = sorted({row['user_id'] for row in pending})
+        balances = dict(db.execute(f'SELECT id, balance FROM users WHERE id IN ({",".join("?" * len(user_ids))})',
+                                   user_ids).fetchall()) if user_ids else {}
+        settled = []
+        for row in pending:
+            delta = row['amount'] if row['type'] == 'Deposit' else -row['amount']
+            if balances.get(row['user_id'], 0) + delta < -1e-9:
+                results[row['id']] = 'insufficient balance'
+                continue
+            balances[row['user_id']] = balances.get(row['user_id'], 0) + delta
+            settled.append(row)
+        movements = [(row['amount'] if row['type'] == 'Deposit' else -row['amount'],
+                      row['amount'] if row['type'] == 'Deposit' else 0,
+                      row['amount'] if row['type'] == 'Withdrawal' else 0,
+                      row['user_id'], row['id']) for row in settled]
+        db.executemany('UPDATE users SET balance = balance + ?, total_deposit = total_deposit + ?, '
+                       'total_withdrawal = total_withdrawal + ? WHERE id = ?', [m[:4] for m in movements])
+        db.executemany("INSERT INTO ledger_entries (user_id, account, ref_id, balance, deposit, withdrawal) "
+                       "VALUES (?, 'transactions', ?, ?, ?, ?)",
+                       [(user_id, tx_id, balance, deposit, withdrawal)
+                        for balance, deposit, withdrawal, user_id, tx_id in movements])
+    status, outcome = ('Completed', 'approved') if action == 'approve' else ('Rejected', 'rejected')
+    db.executemany("UPDATE transactions SET status = ? WHERE id = ? AND status = 'Pending'",
+                   [(status, row['id']) for row in settled])
+    activity_writer.log_many(db, [(row['user_id'], row['type'], transaction_notice(row, action), row['amount'])
+                                  for row in settled])
+    touch_account(*{row['user_id'] for row in settled})
+    results.update((row['id'], outcome) for row in settled)
+    return results
+
+@app.route('/admin/pending')
+@admin_required
+def admin_pending():
+    db = get_db()
+    tx_type = request.args.get('type', '')
+    where, params = ["t.status = 'Pending'"], []
+    if tx_type in ('Deposit', 'Withdrawal'):
+        where.append('t.type = ?')
+        params.append(tx_type)
+    else:
+        tx_type = ''
+    pending, next_cursor = keyset_page(
+        db, 'SELECT t.*, u.name, u.email FROM transactions t JOIN users u ON t.user_id = u.id', where, params,
+        cursor=request.args.get('cursor'), sort='t.created_at', id_col='t.id')
+    return render_template('admin/pending.html', pending=pending, next_cursor=next_cursor, tx_type=tx_type)
+
+@app.route('/admin/transactions/settle', methods=['POST'])
+@admin_required
+def admin_settle_transactions():
+    action = request.form.get('action')
+    ids = [int(i) for i in request.form.getlist('ids') if i.isdigit()][:SETTLE_BATCH_MAX]
+    if action not in ('approve', 'reject') or not ids:
+        if wants_json():
+            return jsonify({'error': 'Choose approve or reject and at least one transaction'}), 400
+        flash('Select at least one transaction.', 'error')
+        return redirect(url_for('admin_pending', type=request.form.get('type', '')))
+    db = get_db()
+    with balance_transaction(db):
+        results = settle_transactions(db, ids, action)
+    counts = {}
+    for outcome in results.values():
+        counts[outcome] = counts.get(outcome, 0) + 1
+    if wants_json():
+        return jsonify({'results': results, 'counts': counts})
+    done = counts.pop('approved', 0) + counts.pop('rejected', 0)
+    summary = f'{done} transaction(s) {"approved" if action == "approve" else "rejected"}.'
+    if counts:
+        summary += ' Skipped: ' + ', '.join(f'{n} {outcome}' for outcome, n in counts.items()) + '.'
+    flash(summary, 'success' if done else 'error')
+    return redirect(url_for('admin_pending', type=request.form.get('type', '')))
+
 # ============================================================
 # NEW ROUTES - Added from reference app screenshots
 # ============================================================
@@ -867,40 +2905,49 @@ def admin_approve_transaction(transaction_id):
 @app.route('/assets')
 @login_required
 def assets():
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    transactions = db.execute('SELECT * FROM transactions WHERE user_id = ? ORDER BY created_at DESC LIMIT 5', (session['user_id'],)).fetchall()
-    db.close()
-    return render_template('assets.html', user=user, transactions=transactions)
+    account = current_account(get_db())
+    return render_template('assets.html', user=account['user'], transactions=account['transactions'])
 
 @app.route('/trade', methods=['GET', 'POST'])
 @login_required
 def trade():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
     if request.method == 'POST':
         symbol = request.form.get('symbol', 'BTC')
         trade_type = request.form.get('trade_type', 'Buy')
         amount = float(request.form.get('amount', 0))
         duration = request.form.get('duration', '1h')
-        stop_loss = request.form.get('stop_loss') or None
-        take_profit = request.form.get('take_profit') or None
+        stop_loss = request.form.get('stop_loss', type=float)
+        take_profit = request.form.get('take_profit', type=float)
+        seconds = parse_duration(duration)
+        entry_price = mark_prices().get(symbol)
+        # Levels are prices: a Buy stops out below the entry and takes profit above it, a Sell the reverse
+        below, above = (stop_loss, take_profit) if trade_type == 'Buy' else (take_profit, stop_loss)
         if amount <= 0:
             flash('Please enter a valid amount.', 'error')
-        elif amount > user['balance']:
-            flash('Insufficient balance!', 'error')
+        elif not seconds:
+            flash('Please choose a valid duration.', 'error')
+        elif (stop_loss is not None or take_profit is not None) and entry_price is None:
+            flash(f'Stop loss and take profit are unavailable for {symbol} right now.', 'error')
+        elif (below is not None and below >= entry_price) or (above is not None and above <= entry_price):
+            if trade_type == 'Buy':
+                flash(f'For a Buy, stop loss must be below and take profit above the current price (${entry_price:,.2f}).', 'error')
+            else:
+                flash(f'For a Sell, stop loss must be above and take profit below the current price (${entry_price:,.2f}).', 'error')
         else:
-            db.execute('INSERT INTO trades (user_id, symbol, trade_type, amount, duration, stop_loss, take_profit) VALUES (?,?,?,?,?,?,?)',
-                (session['user_id'], symbol, trade_type, amount, duration, stop_loss, take_profit))
-            db.execute('UPDATE users SET balance = balance - ? WHERE id = ?', (amount, session['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (session['user_id'], 'Trade Opened', f'{trade_type} {symbol} for ${amount:.2f}', amount))
-            db.commit()
-            flash(f'{trade_type} order placed for {symbol} — ${amount:.2f}!', 'success')
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    open_trades = db.execute("SELECT * FROM trades WHERE user_id = ? AND status = 'Open' ORDER BY created_at DESC", (session['user_id'],)).fetchall()
+            try:
+                with balance_transaction(db):
+                    cur = db.execute('INSERT INTO trades (user_id, symbol, trade_type, amount, duration, stop_loss, take_profit, entry_price, expires_at) '
+                                     "VALUES (?,?,?,?,?,?,?,?, datetime('now', ?))",
+                        (session['user_id'], symbol, trade_type, amount, duration, stop_loss, take_profit, entry_price, f'+{seconds} seconds'))
+                    debit_balance(db, session['user_id'], amount, 'trades', cur.lastrowid)
+                    log_activity(db, session['user_id'], 'Trade Opened', f'{trade_type} {symbol} for ${amount:.2f}', amount)
+                flash(f'{trade_type} order placed for {symbol} — ${amount:.2f}!', 'success')
+            except InsufficientBalance:
+                flash('Insufficient balance!', 'error')
+    user = current_account(db)['user']
+    open_trades = value_open_trades(db, mark_prices(), ('t.user_id = ?',), (session['user_id'],))
     closed_trades = db.execute("SELECT * FROM trades WHERE user_id = ? AND status != 'Open' ORDER BY created_at DESC LIMIT 20", (session['user_id'],)).fetchall()
-    db.close()
     return render_template('trade.html', user=user, open_trades=open_trades, closed_trades=closed_trades)
 
 @app.route('/trade/close/<int:trade_id>', methods=['POST'])
@@ -909,51 +2956,52 @@ def close_trade(trade_id):
     db = get_db()
     trade = db.execute('SELECT * FROM trades WHERE id = ? AND user_id = ?', (trade_id, session['user_id'])).fetchone()
     if trade:
-        import random
-        pnl = round(trade['amount'] * random.uniform(-0.08, 0.18), 2)
+        # Close at the market; without a mark (stocks, no price feed) the stake comes back flat
+        exit_price, pnl = trade_mark(db, trade_id)
+        pnl = pnl or 0
         returned = trade['amount'] + pnl
-        db.execute('UPDATE trades SET status = ?, profit_loss = ? WHERE id = ?', ('Closed', pnl, trade_id))
-        db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (returned, max(pnl,0), session['user_id']))
-        db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-            (session['user_id'], 'Trade Closed', f'Closed {trade["trade_type"]} {trade["symbol"]} P&L: ${pnl:.2f}', returned))
-        db.commit()
-        flash(f'Trade closed. P&L: ${pnl:+.2f} returned to balance.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                set_status(db, 'trades', trade_id, 'Open', 'Closed', profit_loss=pnl, exit_price=exit_price)
+                credit_balance(db, session['user_id'], returned, 'trades', trade_id, profit=max(pnl, 0))
+                log_activity(db, session['user_id'], 'Trade Closed',
+                             f'Closed {trade["trade_type"]} {trade["symbol"]} P&L: ${pnl:.2f}', returned)
+            trigger_book.discard(trade_id)
+            flash(f'Trade closed. P&L: ${pnl:+.2f} returned to balance.', 'success')
+        except StaleState:
+            flash('This trade is already closed.', 'error')
     return redirect(url_for('trade'))
 
 @app.route('/markets')
 @login_required
 def markets():
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    db.close()
-    return render_template('markets.html', user=user)
+    return render_template('markets.html', user=current_account(get_db())['user'])
 
 @app.route('/stake', methods=['GET', 'POST'])
 @login_required
 def stake():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
     if request.method == 'POST':
         asset = request.form.get('asset')
         amount = float(request.form.get('amount', 0))
         daily_rate = float(request.form.get('daily_rate', 0.5))
         if amount <= 0:
             flash('Invalid amount.', 'error')
-        elif amount > user['balance']:
-            flash('Insufficient balance!', 'error')
         else:
-            db.execute('INSERT INTO stakes (user_id, asset, amount, daily_rate) VALUES (?,?,?,?)',
-                (session['user_id'], asset, amount, daily_rate))
-            db.execute('UPDATE users SET balance = balance - ? WHERE id = ?', (amount, session['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (session['user_id'], 'Staking Started', f'Staked {amount} {asset}', amount))
-            db.commit()
-            flash(f'Successfully staked ${amount:.2f} in {asset}!', 'success')
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    stakings = db.execute('SELECT * FROM stakes WHERE user_id = ? ORDER BY created_at DESC', (session['user_id'],)).fetchall()
-    db.close()
-    return render_template('stake.html', user=user, stakings=stakings)
+            try:
+                with balance_transaction(db):
+                    cur = db.execute('INSERT INTO stakes (user_id, asset, amount, daily_rate) VALUES (?,?,?,?)',
+                        (session['user_id'], asset, amount, daily_rate))
+                    debit_balance(db, session['user_id'], amount, 'stakes', cur.lastrowid)
+                    log_activity(db, session['user_id'], 'Staking Started', f'Staked {amount} {asset}', amount)
+                flash(f'Successfully staked ${amount:.2f} in {asset}!', 'success')
+            except InsufficientBalance:
+                flash('Insufficient balance!', 'error')
+    user = current_account(db)['user']
+    stakings, next_cursor = history_page(db, 'stakes', session['user_id'])
+    if wants_json():
+        return history_json(stakings, next_cursor)
+    return render_template('stake.html', user=user, stakings=stakings, next_cursor=next_cursor)
 
 @app.route('/stake/unstake/<int:stake_id>', methods=['POST'])
 @login_required
@@ -962,18 +3010,19 @@ def unstake(stake_id):
     stake = db.execute('SELECT * FROM stakes WHERE id = ? AND user_id = ?', (stake_id, session['user_id'])).fetchone()
     if stake and stake['status'] == 'Active':
         total = stake['amount'] + stake['earnings']
-        db.execute('UPDATE stakes SET status = ? WHERE id = ?', ('Unstaked', stake_id))
-        db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (total, stake['earnings'], session['user_id']))
-        db.commit()
-        flash(f'Unstaked successfully. ${total:.2f} returned to balance.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                set_status(db, 'stakes', stake_id, 'Active', 'Unstaked')
+                credit_balance(db, session['user_id'], total, 'stakes', stake_id, profit=stake['earnings'])
+            flash(f'Unstaked successfully. ${total:.2f} returned to balance.', 'success')
+        except StaleState:
+            flash('This stake has already been unstaked.', 'error')
     return redirect(url_for('stake'))
 
 @app.route('/subscribe', methods=['GET', 'POST'])
 @login_required
 def subscribe():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
     if request.method == 'POST':
         plan = request.form.get('plan')
         amount = float(request.form.get('amount', 0))
@@ -981,53 +3030,54 @@ def subscribe():
         days = int(request.form.get('days', 14))
         if amount <= 0:
             flash('Invalid amount.', 'error')
-        elif amount > user['balance']:
-            flash('Insufficient balance!', 'error')
+        elif days <= 0:
+            flash('Invalid duration.', 'error')
         else:
-            db.execute('INSERT INTO subscriptions (user_id, plan, amount, roi_percent, duration_days) VALUES (?,?,?,?,?)',
-                (session['user_id'], plan, amount, roi, days))
-            db.execute('UPDATE users SET balance = balance - ? WHERE id = ?', (amount, session['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (session['user_id'], 'Plan Subscribed', f'Subscribed to {plan} plan for ${amount:.2f}', amount))
-            db.commit()
-            flash(f'Successfully subscribed to {plan} plan!', 'success')
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    subscriptions = db.execute('SELECT * FROM subscriptions WHERE user_id = ? ORDER BY created_at DESC', (session['user_id'],)).fetchall()
-    db.close()
-    return render_template('subscribe.html', user=user, subscriptions=subscriptions)
+            try:
+                with balance_transaction(db):
+                    cur = db.execute('INSERT INTO subscriptions (user_id, plan, amount, roi_percent, duration_days, ends_at) '
+                                     "VALUES (?,?,?,?,?, datetime('now', ?))",
+                        (session['user_id'], plan, amount, roi, days, f'+{days} days'))
+                    debit_balance(db, session['user_id'], amount, 'subscriptions', cur.lastrowid)
+                    log_activity(db, session['user_id'], 'Plan Subscribed', f'Subscribed to {plan} plan for ${amount:.2f}', amount)
+                flash(f'Successfully subscribed to {plan} plan!', 'success')
+            except InsufficientBalance:
+                flash('Insufficient balance!', 'error')
+    user = current_account(db)['user']
+    subscriptions, next_cursor = history_page(db, 'subscriptions', session['user_id'])
+    if wants_json():
+        return history_json(subscriptions, next_cursor)
+    return render_template('subscribe.html', user=user, subscriptions=subscriptions, next_cursor=next_cursor)
 
 @app.route('/signals', methods=['GET', 'POST'])
 @login_required
 def signals():
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
     if request.method == 'POST':
         signal_name = request.form.get('signal_name')
         amount = float(request.form.get('amount', 0))
         if amount <= 0:
             flash('Invalid amount.', 'error')
-        elif amount > user['balance']:
-            flash('Insufficient balance!', 'error')
         else:
-            db.execute('INSERT INTO signal_purchases (user_id, signal_name, amount) VALUES (?,?,?)',
-                (session['user_id'], signal_name, amount))
-            db.execute('UPDATE users SET balance = balance - ? WHERE id = ?', (amount, session['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (session['user_id'], 'Signal Purchased', f'Purchased {signal_name} signal for ${amount:.2f}', amount))
-            db.commit()
-            flash(f'Signal "{signal_name}" purchased successfully!', 'success')
-        user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    purchases = db.execute('SELECT * FROM signal_purchases WHERE user_id = ? ORDER BY created_at DESC', (session['user_id'],)).fetchall()
-    db.close()
-    return render_template('signals.html', user=user, purchases=purchases)
+            try:
+                with balance_transaction(db):
+                    cur = db.execute('INSERT INTO signal_purchases (user_id, signal_name, amount) VALUES (?,?,?)',
+                        (session['user_id'], signal_name, amount))
+                    debit_balance(db, session['user_id'], amount, 'signal_purchases', cur.lastrowid)
+                    log_activity(db, session['user_id'], 'Signal Purchased', f'Purchased {signal_name} signal for ${amount:.2f}', amount)
+                flash(f'Signal "{signal_name}" purchased successfully!', 'success')
+            except InsufficientBalance:
+                flash('Insufficient balance!', 'error')
+    user = current_account(db)['user']
+    purchases, next_cursor = history_page(db, 'signal_purchases', session['user_id'])
+    if wants_json():
+        return history_json(purchases, next_cursor)
+    return render_template('signals.html', user=user, purchases=purchases, next_cursor=next_cursor)
 
 @app.route('/settings')
 @login_required
 def settings():
-    db = get_db()
-    user = db.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    db.close()
-    return render_template('settings.html', user=user)
+    return render_template('settings.html', user=current_account(get_db())['user'])
 
 @app.route('/settings/update', methods=['POST'])
 @login_required
@@ -1039,7 +3089,7 @@ def settings_update():
         db = get_db()
         db.execute('UPDATE users SET name = ? WHERE id = ?', (name, session['user_id']))
         db.commit()
-        db.close()
+        touch_account(session['user_id'])
         session['user_name'] = name
         flash('Profile updated successfully!', 'success')
     return redirect(url_for('settings'))
@@ -1061,47 +3111,120 @@ def change_password():
         db.execute('UPDATE users SET password = ? WHERE id = ?', (hash_password(new_pw), session['user_id']))
         db.commit()
         flash('Password changed successfully!', 'success')
-    db.close()
     return redirect(url_for('settings'))
 
+# Admin listings: one engine for the trades/stakes/subscriptions/signals/copy-trades screens.
+# Each maps to (table, statuses offered in the filter).
+ADMIN_LISTINGS = {
+    'trades': ('trades', ('Open', 'Closed')),
+    'stakes': ('stakes', ('Active', 'Unstaked')),
+    'subscriptions': ('subscriptions', ('Active', 'Completed', 'Expired')),
+    'signals': ('signal_purchases', ('Active', 'Expired')),
+    'copy_trades': ('copy_trades', ('Active', 'Stopped')),
+}
+_admin_counts = {}
+
+def parse_filter_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+def cached_count(db, table, where, params):
+    """COUNT(*) for a filtered listing, reused for ADMIN_TOTALS_TTL seconds."""
+    key = (table, tuple(where), tuple(params))
+    hit = _admin_counts.get(key)
+    if hit and time.monotonic() - hit[1] < ADMIN_TOTALS_TTL:
+        return hit[0]
+    sql = f'SELECT COUNT(*) FROM {table} x'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    count = db.execute(sql, params).fetchone()[0]
+    if len(_admin_counts) > 256:
+        _admin_counts.clear()
+    _admin_counts[key] = (count, time.monotonic())
+    return count
+
+def admin_listing(db, name):
+    """Filtered keyset page for an ADMIN_LISTINGS screen.
+
+    Reads status, user (id or email), from and to (YYYY-MM-DD) from the query string.
+    Returns the template context: rows, next_cursor, total, statuses and filters.
+    """
+    table, statuses = ADMIN_LISTINGS[name]
+    filters = {key: request.args.get(key, '').strip() for key in ('status', 'user', 'from', 'to')}
+    where, params = [], []
+    if filters['status'] in statuses:
+        where.append('x.status = ?')
+        params.append(filters['status'])
+    else:
+        filters['status'] = ''
+    if filters['user']:
+        if filters['user'].isdigit():
+            user_id = int(filters['user'])
+        else:
+            row = db.execute('SELECT id FROM users WHERE email = ? COLLATE NOCASE', (filters['user'],)).fetchone()
+            user_id = row['id'] if row else 0
+        where.append('x.user_id = ?')
+        params.append(user_id)
+    since, until = parse_filter_date(filters['from']), parse_filter_date(filters['to'])
+    if since:
+        where.append('x.created_at >= ?')
+        params.append(since)
+    if until:
+        where.append("x.created_at < date(?, '+1 day')")
+        params.append(until)
+    filters['from'], filters['to'] = since or '', until or ''
+    rows, next_cursor = keyset_page(
+        db, f'SELECT x.*, u.name, u.email FROM {table} x JOIN users u ON x.user_id = u.id', where, params,
+        cursor=request.args.get('cursor'), sort='x.created_at', id_col='x.id')
+    return {'rows': rows, 'next_cursor': next_cursor, 'total': cached_count(db, table, where, params),
+            'statuses': statuses, 'filters': filters}
+
 # Admin: view all trades
 @app.route('/admin/trades')
 @admin_required
 def admin_trades():
     db = get_db()
-    trades = db.execute('''SELECT t.*, u.name, u.email FROM trades t
-                           JOIN users u ON t.user_id = u.id
-                           ORDER BY t.created_at DESC''').fetchall()
-    db.close()
-    return render_template('admin/trades.html', trades=trades)
+    listing = admin_listing(db, 'trades')
+    open_ids = [t['id'] for t in listing['rows'] if t['status'] == 'Open']
+    marks = {}
+    if open_ids:
+        rows = value_open_trades(db, mark_prices(), (f"t.id IN ({','.join('?' * len(open_ids))})",), open_ids)
+        marks = {r['id']: r for r in rows}
+    return render_template('admin/trades.html', trades=listing.pop('rows'), marks=marks, **listing)
 
 @app.route('/admin/trade/<int:trade_id>/close', methods=['POST'])
 @admin_required
 def admin_close_trade(trade_id):
-    pnl = float(request.form.get('pnl', 0))
     db = get_db()
     trade = db.execute('SELECT * FROM trades WHERE id = ?', (trade_id,)).fetchone()
     if trade:
+        # Closes at the live mark unless the admin typed a P&L; the exit price then follows it
+        exit_price, pnl = trade_mark(db, trade_id)
+        if request.form.get('pnl'):
+            pnl = float(request.form['pnl'])
+            exit_price = override_exit_price(trade, pnl)
+        pnl = pnl or 0
         returned = trade['amount'] + pnl
-        db.execute('UPDATE trades SET status = ?, profit_loss = ? WHERE id = ?', ('Closed', pnl, trade_id))
-        db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (returned, max(pnl,0), trade['user_id']))
-        db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-            (trade['user_id'], 'Trade Closed', f'Your {trade["trade_type"]} trade on {trade["symbol"]} was closed. P&L: ${pnl:+.2f}', returned))
-        db.commit()
-        flash(f'Trade #{trade_id} closed. P&L: ${pnl:+.2f} — balance updated.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                set_status(db, 'trades', trade_id, 'Open', 'Closed', profit_loss=pnl, exit_price=exit_price)
+                credit_balance(db, trade['user_id'], returned, 'trades', trade_id, profit=max(pnl, 0))
+                log_activity(db, trade['user_id'], 'Trade Closed',
+                             f'Your {trade["trade_type"]} trade on {trade["symbol"]} was closed. P&L: ${pnl:+.2f}', returned)
+            trigger_book.discard(trade_id)
+            flash(f'Trade #{trade_id} closed. P&L: ${pnl:+.2f} — balance updated.', 'success')
+        except StaleState:
+            flash(f'Trade #{trade_id} is already closed.', 'error')
     return redirect(url_for('admin_trades'))
 
 # Admin: view all stakes
 @app.route('/admin/stakes')
 @admin_required
 def admin_stakes():
-    db = get_db()
-    stakes = db.execute('''SELECT s.*, u.name, u.email FROM stakes s
-                           JOIN users u ON s.user_id = u.id
-                           ORDER BY s.created_at DESC''').fetchall()
-    db.close()
-    return render_template('admin/stakes.html', stakes=stakes)
+    listing = admin_listing(get_db(), 'stakes')
+    return render_template('admin/stakes.html', stakes=listing.pop('rows'), **listing)
 
 @app.route('/admin/stake/<int:stake_id>/update', methods=['POST'])
 @admin_required
@@ -1112,34 +3235,36 @@ def admin_update_stake(stake_id):
     stake = db.execute('SELECT * FROM stakes WHERE id = ?', (stake_id,)).fetchone()
     if stake:
         prev_earnings = stake['earnings']
-        db.execute('UPDATE stakes SET earnings = ?, status = ? WHERE id = ?', (earnings, status, stake_id))
-        if status == 'Unstaked':
-            total = stake['amount'] + earnings
-            db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (total, earnings, stake['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (stake['user_id'], 'Staking Started', f'Your {stake["asset"]} stake was unstaked. Earnings: ${earnings:.2f} returned to balance.', total))
-        elif earnings != prev_earnings:
-            # Profit updated while still active - credit difference to balance
-            diff = earnings - prev_earnings
-            if diff > 0:
-                db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (diff, diff, stake['user_id']))
-                db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                    (stake['user_id'], 'Staking Started', f'Staking profit of ${diff:.2f} credited to your account from {stake["asset"]} stake.', diff))
-        db.commit()
-        flash(f'Stake #{stake_id} updated. Balance credited.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                # Guard on the earnings we read so a concurrent update can't credit the same diff twice
+                cur = db.execute('UPDATE stakes SET earnings = ?, status = ? WHERE id = ? AND status = ? AND earnings = ?',
+                                 (earnings, status, stake_id, 'Active', prev_earnings))
+                if cur.rowcount != 1:
+                    raise StaleState()
+                if status == 'Unstaked':
+                    total = stake['amount'] + earnings
+                    credit_balance(db, stake['user_id'], total, 'stakes', stake_id, profit=earnings)
+                    log_activity(db, stake['user_id'], 'Staking Started',
+                                 f'Your {stake["asset"]} stake was unstaked. Earnings: ${earnings:.2f} returned to balance.', total)
+                elif earnings != prev_earnings:
+                    # Profit updated while still active - credit difference to balance
+                    diff = earnings - prev_earnings
+                    if diff > 0:
+                        credit_balance(db, stake['user_id'], diff, 'stakes', stake_id, profit=diff)
+                        log_activity(db, stake['user_id'], 'Staking Started',
+                                     f'Staking profit of ${diff:.2f} credited to your account from {stake["asset"]} stake.', diff)
+            flash(f'Stake #{stake_id} updated. Balance credited.', 'success')
+        except StaleState:
+            flash(f'Stake #{stake_id} changed in the meantime; reload and try again.', 'error')
     return redirect(url_for('admin_stakes'))
 
 # Admin: view all subscriptions
 @app.route('/admin/subscriptions')
 @admin_required
 def admin_subscriptions():
-    db = get_db()
-    subs = db.execute('''SELECT s.*, u.name, u.email FROM subscriptions s
-                         JOIN users u ON s.user_id = u.id
-                         ORDER BY s.created_at DESC''').fetchall()
-    db.close()
-    return render_template('admin/subscriptions.html', subs=subs)
+    listing = admin_listing(get_db(), 'subscriptions')
+    return render_template('admin/subscriptions.html', subs=listing.pop('rows'), **listing)
 
 @app.route('/admin/subscription/<int:sub_id>/update', methods=['POST'])
 @admin_required
@@ -1150,33 +3275,34 @@ def admin_update_subscription(sub_id):
     sub = db.execute('SELECT * FROM subscriptions WHERE id = ?', (sub_id,)).fetchone()
     if sub:
         prev_earnings = sub['earnings']
-        db.execute('UPDATE subscriptions SET earnings = ?, status = ? WHERE id = ?', (earnings, status, sub_id))
-        if status == 'Completed':
-            total = sub['amount'] + earnings
-            db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (total, earnings, sub['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (sub['user_id'], 'Plan Subscribed', f'Your {sub["plan"]} plan completed. Earnings: ${earnings:.2f} credited to balance.', total))
-        elif earnings != prev_earnings:
-            diff = earnings - prev_earnings
-            if diff > 0:
-                db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (diff, diff, sub['user_id']))
-                db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                    (sub['user_id'], 'Plan Subscribed', f'Subscription profit of ${diff:.2f} credited from {sub["plan"]} plan.', diff))
-        db.commit()
-        flash(f'Subscription #{sub_id} updated. Balance credited.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                cur = db.execute('UPDATE subscriptions SET earnings = ?, status = ? WHERE id = ? AND status = ? AND earnings = ?',
+                                 (earnings, status, sub_id, 'Active', prev_earnings))
+                if cur.rowcount != 1:
+                    raise StaleState()
+                if status == 'Completed':
+                    total = sub['amount'] + earnings
+                    credit_balance(db, sub['user_id'], total, 'subscriptions', sub_id, profit=earnings)
+                    log_activity(db, sub['user_id'], 'Plan Subscribed',
+                                 f'Your {sub["plan"]} plan completed. Earnings: ${earnings:.2f} credited to balance.', total)
+                elif earnings != prev_earnings:
+                    diff = earnings - prev_earnings
+                    if diff > 0:
+                        credit_balance(db, sub['user_id'], diff, 'subscriptions', sub_id, profit=diff)
+                        log_activity(db, sub['user_id'], 'Plan Subscribed',
+                                     f'Subscription profit of ${diff:.2f} credited from {sub["plan"]} plan.', diff)
+            flash(f'Subscription #{sub_id} updated. Balance credited.', 'success')
+        except StaleState:
+            flash(f'Subscription #{sub_id} changed in the meantime; reload and try again.', 'error')
     return redirect(url_for('admin_subscriptions'))
 
 # Admin: view all signals
 @app.route('/admin/signals')
 @admin_required
 def admin_signals():
-    db = get_db()
-    sigs = db.execute('''SELECT sp.*, u.name, u.email FROM signal_purchases sp
-                         JOIN users u ON sp.user_id = u.id
-                         ORDER BY sp.created_at DESC''').fetchall()
-    db.close()
-    return render_template('admin/signals.html', sigs=sigs)
+    listing = admin_listing(get_db(), 'signals')
+    return render_template('admin/signals.html', sigs=listing.pop('rows'), **listing)
 
 @app.route('/admin/signal/<int:sig_id>/update', methods=['POST'])
 @admin_required
@@ -1186,19 +3312,14 @@ def admin_update_signal(sig_id):
     db.execute('UPDATE signal_purchases SET status = ? WHERE id = ?', (status, sig_id))
     db.commit()
     flash(f'Signal #{sig_id} updated to {status}.', 'success')
-    db.close()
     return redirect(url_for('admin_signals'))
 
 # Admin: view copy trades
 @app.route('/admin/copy-trades')
 @admin_required
 def admin_copy_trades():
-    db = get_db()
-    trades = db.execute('''SELECT ct.*, u.name, u.email FROM copy_trades ct
-                           JOIN users u ON ct.user_id = u.id
-                           ORDER BY ct.created_at DESC''').fetchall()
-    db.close()
-    return render_template('admin/copy_trades.html', trades=trades)
+    listing = admin_listing(get_db(), 'copy_trades')
+    return render_template('admin/copy_trades.html', trades=listing.pop('rows'), **listing)
 
 @app.route('/admin/copy-trade/<int:trade_id>/update', methods=['POST'])
 @admin_required
@@ -1209,31 +3330,115 @@ def admin_update_copy_trade(trade_id):
     ct = db.execute('SELECT * FROM copy_trades WHERE id = ?', (trade_id,)).fetchone()
     if ct:
         prev_profit = ct['total_profit']
-        db.execute('UPDATE copy_trades SET total_profit = ?, status = ? WHERE id = ?', (profit, status, trade_id))
-        if status == 'Stopped':
-            total = ct['amount'] + profit
-            db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (total, max(profit,0), ct['user_id']))
-            db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                (ct['user_id'], 'Copy Trade Stopped', f'Copy trading with {ct["trader_name"]} stopped. Profit: ${profit:.2f} + investment returned.', total))
-        elif profit != prev_profit:
-            diff = profit - prev_profit
-            if diff > 0:
-                db.execute('UPDATE users SET balance = balance + ?, profit = profit + ? WHERE id = ?', (diff, diff, ct['user_id']))
-                db.execute('INSERT INTO trading_activity (user_id, activity_type, description, amount) VALUES (?,?,?,?)',
-                    (ct['user_id'], 'Copy Trade Started', f'Copy trading profit of ${diff:.2f} credited from {ct["trader_name"]}.', diff))
-        db.commit()
-        flash(f'Copy trade #{trade_id} updated. Profit credited to user.', 'success')
-    db.close()
+        try:
+            with balance_transaction(db):
+                cur = db.execute('UPDATE copy_trades SET total_profit = ?, status = ? WHERE id = ? AND status = ? AND total_profit = ?',
+                                 (profit, status, trade_id, 'Active', prev_profit))
+                if cur.rowcount != 1:
+                    raise StaleState()
+                touch_account(ct['user_id'])  # the dashboard lists active copy trades
+                if status == 'Stopped':
+                    total = ct['amount'] + profit
+                    credit_balance(db, ct['user_id'], total, 'copy_trades', trade_id, profit=max(profit, 0))
+                    log_activity(db, ct['user_id'], 'Copy Trade Stopped',
+                                 f'Copy trading with {ct["trader_name"]} stopped. Profit: ${profit:.2f} + investment returned.', total)
+                elif profit != prev_profit:
+                    diff = profit - prev_profit
+                    if diff > 0:
+                        credit_balance(db, ct['user_id'], diff, 'copy_trades', trade_id, profit=diff)
+                        log_activity(db, ct['user_id'], 'Copy Trade Started',
+                                     f'Copy trading profit of ${diff:.2f} credited from {ct["trader_name"]}.', diff)
+            flash(f'Copy trade #{trade_id} updated. Profit credited to user.', 'success')
+        except StaleState:
+            flash(f'Copy trade #{trade_id} changed in the meantime; reload and try again.', 'error')
     return redirect(url_for('admin_copy_trades'))
 
+# Admin: streaming exports for reconciliation
+EXPORT_TABLES = ('users', 'transactions', 'trades', 'stakes', 'subscriptions', 'trading_activity',
+                 'ledger_entries')
+EXPORT_EXCLUDED_COLUMNS = {'users': ('password', 'verification_code')}
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+def export_rows(table, since=None, until=None):
+    """Yield the exported column names, then batches of rows walking `table` by rowid.
+
+    Each batch is its own short query on a dedicated connection, so an export never
+    pins one long read snapshot and memory stays at one batch whatever the table size.
+    """
+    conn = connect_db()
+    try:
+        columns = [r[1] for r in conn.execute(f'PRAGMA table_info({table})')
+                   if r[1] not in EXPORT_EXCLUDED_COLUMNS.get(table, ())]
+        where, params = ['id > ?'], []
+        if since:
+            where.append('created_at >= ?')
+            params.append(since)
+        if until:
+            where.append("created_at < date(?, '+1 day')")
+            params.append(until)
+        sql = (f'SELECT {", ".join(columns)} FROM {table} WHERE {" AND ".join(where)} '
+               f'ORDER BY id LIMIT {EXPORT_BATCH_SIZE}')
+        yield columns
+        last_id = 0
+        while True:
+            batch = conn.execute(sql, [last_id, *params]).fetchall()
+            if not batch:
+                break
+            yield batch
+            last_id = batch[-1]['id']
+            time.sleep(0)  # let other greenlets run between batches
+    finally:
+        conn.close()
+
+def export_csv(table, since, until):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    rows = export_rows(table, since, until)
+    writer.writerow(next(rows))
+    for batch in rows:
+        writer.writerows(tuple(row) for row in batch)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()  # header only, when nothing matched
+
+def export_ndjson(table, since, until):
+    rows = export_rows(table, since, until)
+    next(rows)
+    for batch in rows:
+        yield ''.join(json.dumps(dict(row), default=str) + '\n' for row in batch)
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.route('/admin/export/<table>.<fmt>')
+@admin_required
+def admin_export(table, fmt):
+    if table not in EXPORT_TABLES or fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Unknown export'}), 404
+    since = parse_filter_date(request.args.get('from', ''))
+    until = parse_filter_date(request.args.get('to', ''))
+    if fmt == 'csv':
+        body, mimetype = export_csv(table, since, until), 'text/csv'
+    else:
+        body, mimetype = export_ndjson(table, since, until), 'application/x-ndjson'
+    filename = f'{table}-{datetime.now(timezone.utc):%Y%m%d}.{fmt}'
+    if request.args.get('gzip') in ('1', 'true', 'yes'):
+        body, mimetype, filename = gzip_stream(body), 'application/gzip', filename + '.gz'
+    return app.response_class(body, mimetype=mimetype,
+                              headers={'Content-Disposition': f'attachment; filename={filename}',
+                                       'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
 # Admin: manage copy traders
 @app.route('/admin/traders')
 @admin_required
 def admin_traders():
-    db = get_db()
-    traders = db.execute('SELECT * FROM traders ORDER BY created_at DESC').fetchall()
-    db.close()
-    return render_template('admin/traders.html', traders=traders)
+    return render_template('admin/traders.html', traders=get_traders())
 
 @app.route('/admin/traders/add', methods=['POST'])
 @admin_required
@@ -1251,8 +3456,8 @@ def admin_add_trader():
         int(request.form.get('copiers', 0)),
         float(request.form.get('profit_share', 10)),
     ))
+    invalidate_reference(db, 'traders')
     db.commit()
-    db.close()
     flash('Trader added successfully!', 'success')
     return redirect(url_for('admin_traders'))
 
@@ -1274,8 +3479,8 @@ def admin_edit_trader(trader_id):
         int(request.form.get('is_active', 1)),
         trader_id
     ))
+    invalidate_reference(db, 'traders')
     db.commit()
-    db.close()
     flash('Trader updated!', 'success')
     return redirect(url_for('admin_traders'))
 
@@ -1284,10 +3489,11 @@ def admin_edit_trader(trader_id):
 def admin_delete_trader(trader_id):
     db = get_db()
     db.execute('DELETE FROM traders WHERE id = ?', (trader_id,))
+    invalidate_reference(db, 'traders')
     db.commit()
-    db.close()
     flash('Trader removed.', 'success')
     return redirect(url_for('admin_traders'))
 
 if __name__ == '__main__':
+    init_db()
     app.run(debug=True, host='127.0.0.1', port=5000)
@@ -0,0 +1,51 @@
+import csv
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Configure before app is imported: a throwaway database and no background threads
+os.environ['DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'export.db')
+os.environ['PRICE_POLLER'] = '0'
+os.environ['SCHEDULER'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as broker  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def user_id():
+    broker.init_db()
+    conn = broker.connect_db()
+    try:
+        cur = conn.execute('INSERT INTO users (name, email, password, is_verified, verification_code) '
+                           'VALUES (?, ?, ?, 1, ?)',
+                           ('Export Test', 'export@example.com', broker.hash_password('secret'), '123456'))
+        conn.commit()
+        return cur.lastrowid
+    finally:
+        conn.close()
+
+
+def test_export_rows_omit_credentials(user_id):
+    rows = broker.export_rows('users')
+    columns = next(rows)
+    exported = [dict(row) for batch in rows for row in batch]
+    assert 'email' in columns
+    assert 'password' not in columns
+    assert 'verification_code' not in columns
+    assert any(row['id'] == user_id for row in exported)
+    assert all('verification_code' not in row and 'password' not in row for row in exported)
+
+
+def test_users_csv_omits_credentials(user_id):
+    broker.app.testing = True
+    client = broker.app.test_client()
+    client.post('/login', data={'email': broker.ADMIN_EMAIL, 'password': 'MAro45??!!'})
+    resp = client.get('/admin/export/users.csv')
+    assert resp.status_code == 200
+    header, *rows = csv.reader(io.StringIO(resp.get_data(as_text=True)))
+    assert 'verification_code' not in header and 'password' not in header
+    assert '123456' not in {value for row in rows for value in row}